@@ -4,6 +4,7 @@ class Settings(BaseSettings):
     OPENWEATHER_API_KEY: str
     OPENAI_API_KEY: str
     OPENAI_API_KEY2: str  # İkinci GPT API anahtarı
+    OPENAI_EXTRA_API_KEYS: str = ""  # Virgülle ayrılmış ek GPT API anahtarları
     SECRET_KEY: str
     ALGORITHM: str
     ACCESS_TOKEN_EXPIRE_MINUTES: int
@@ -15,6 +16,12 @@ class Settings(BaseSettings):
     APPLE_CLIENT_ID: str = ""
     APPLE_TEAM_ID: str = ""
     APPLE_KEY_ID: str = ""
+    
+    # Eş zamanlı kombin isteklerini tek GPT çağrısında toplama (varsayılan kapalı)
+    GPT_BATCHING_ENABLED: bool = False
+
+    # Açıkken /suggest-outfit yanıtı gönderilmeden önce OutfitResponse ile doğrulanır
+    DEBUG: bool = False
 
     class Config:
         env_file = ".env"
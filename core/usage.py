@@ -1,16 +1,33 @@
+import asyncio
+import logging
 import datetime
+import time
 from google.cloud import firestore
 from typing import Union
 from fastapi import Depends, HTTPException, status
 
 from schemas import DailyUsage
 from core.security import get_current_user_id
+from core.user_cache import invalidate_cached_user
+
+logger = logging.getLogger(__name__)
 
 PLAN_LIMITS = {
     "free": 2,
     "premium": "unlimited"
 }
 
+_today_cache = {"date": "", "expires_at": 0.0}
+
+def get_today_str() -> str:
+    """Bugünün tarihini (YYYY-MM-DD) döner; değer gece yarısına kadar önbellekte tutulur."""
+    now = time.time()
+    if now >= _today_cache["expires_at"]:
+        today = datetime.date.today()
+        next_midnight = datetime.datetime.combine(today + datetime.timedelta(days=1), datetime.time.min)
+        _today_cache.update(date=today.isoformat(), expires_at=next_midnight.timestamp())
+    return _today_cache["date"]
+
 def get_or_create_daily_usage(user_id: str) -> DailyUsage:
     from main import db
 
@@ -24,7 +41,7 @@ def get_or_create_daily_usage(user_id: str) -> DailyUsage:
         user_data = user_doc.to_dict()
         plan = user_data.get("plan", "free")
 
-    today_str = datetime.date.today().isoformat()
+    today_str = get_today_str()
     usage_data = user_data.get("usage")
     
     if usage_data and usage_data.get("date") == today_str:
@@ -39,6 +56,7 @@ def get_or_create_daily_usage(user_id: str) -> DailyUsage:
             "rewarded_count": rewarded_count
         }
         user_ref.set({"usage": new_usage_data}, merge=True)
+        invalidate_cached_user(user_id)
 
     daily_limit = PLAN_LIMITS.get(plan, PLAN_LIMITS["free"])
     
@@ -68,10 +86,10 @@ def increment_usage(user_id: str) -> None:
     def update_in_transaction(transaction, user_ref):
         snapshot = user_ref.get(transaction=transaction)
         if not snapshot.exists:
-            print(f"Error: User {user_id} not found for incrementing usage.")
+            logger.error("User %s not found for incrementing usage.", user_id)
             return 0
         user_data = snapshot.to_dict()
-        today_str = datetime.date.today().isoformat()
+        today_str = get_today_str()
         usage_data = user_data.get("usage")
         if usage_data and usage_data.get("date") == today_str:
             new_count = usage_data.get("count", 0) + 1
@@ -85,11 +103,12 @@ def increment_usage(user_id: str) -> None:
 
     transaction = db.transaction()
     new_usage_count = update_in_transaction(transaction, user_ref)
-    print(f"Usage for user {user_id} incremented to {new_usage_count}")
+    invalidate_cached_user(user_id)
+    logger.info("Usage for user %s incremented to %s", user_id, new_usage_count)
 
 async def check_usage_limit(user_id_tuple: tuple = Depends(get_current_user_id)):
     user_id, is_anonymous = user_id_tuple
-    usage_status = get_or_create_daily_usage(user_id)
+    usage_status = await asyncio.to_thread(get_or_create_daily_usage, user_id)
     
     if usage_status.remaining == 0:
         if isinstance(usage_status.daily_limit, int):
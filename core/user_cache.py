@@ -0,0 +1,62 @@
+# core/user_cache.py
+
+"""
+Kullanıcı dokümanları için süreç içi, kısa ömürlü (TTL) önbellek.
+Sık istek atan kullanıcılar için her istekte Firestore'a gitmeyi önler.
+Dokümanı değiştiren her yazma işleminden sonra ilgili kayıt güncellenmeli
+veya geçersiz kılınmalıdır.
+"""
+import asyncio
+import time
+import weakref
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+USER_CACHE: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+USER_CACHE_DURATION = 30  # saniye
+USER_CACHE_MAX_ENTRIES = 10000
+
+# Kilit yalnızca onu tutan/bekleyen istek varken yaşar; silinen, süresi dolan veya hiç önbelleğe
+# girmeyen kullanıcıların kilitleri kendiliğinden temizlenir.
+_user_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+# Firestore'dan okunan doküman önbelleğe girmeden önce çağrılır (ör. henüz yazılmamış kullanım artışları)
+_refill_hooks: List[Callable[[str, Dict[str, Any]], None]] = []
+
+def add_refill_hook(hook: Callable[[str, Dict[str, Any]], None]) -> None:
+    _refill_hooks.append(hook)
+
+def get_cached_user(user_id: str) -> Optional[Dict[str, Any]]:
+    cached = USER_CACHE.get(user_id)
+    if cached is None:
+        return None
+    if time.monotonic() - cached["timestamp"] >= USER_CACHE_DURATION:
+        USER_CACHE.pop(user_id, None)
+        return None
+    USER_CACHE.move_to_end(user_id)
+    return cached["data"]
+
+def set_cached_user(user_id: str, user_data: Dict[str, Any]) -> None:
+    """Firestore'dan okunan dokümanı önbelleğe koyar; kayıtlı refill hook'ları dokümanı yerinde düzeltir."""
+    for hook in _refill_hooks:
+        hook(user_id, user_data)
+    if user_id not in USER_CACHE and len(USER_CACHE) >= USER_CACHE_MAX_ENTRIES:
+        USER_CACHE.popitem(last=False)
+    USER_CACHE[user_id] = {"timestamp": time.monotonic(), "data": user_data}
+    USER_CACHE.move_to_end(user_id)
+
+def update_cached_user(user_id: str, updates: Dict[str, Any]) -> None:
+    """Önbellekteki dokümana üst seviye alanları uygular (kayıt yoksa bir şey yapmaz)."""
+    cached = USER_CACHE.get(user_id)
+    if cached is not None:
+        cached["data"].update(updates)
+
+def invalidate_cached_user(user_id: str) -> None:
+    USER_CACHE.pop(user_id, None)
+
+def get_user_lock(user_id: str) -> asyncio.Lock:
+    """Aynı kullanıcı için eş zamanlı cache miss'lerin tek bir okumada birleşmesini sağlar."""
+    lock = _user_locks.get(user_id)
+    if lock is None:
+        lock = _user_locks[user_id] = asyncio.Lock()
+    return lock
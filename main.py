@@ -1,21 +1,34 @@
 import uvicorn
 import firebase_admin
 from fastapi import FastAPI, Request
-from fastapi.responses import RedirectResponse, JSONResponse
+from fastapi.responses import ORJSONResponse, RedirectResponse, JSONResponse
 from fastapi.exceptions import RequestValidationError
 from firebase_admin import credentials, firestore
-import json
+import orjson
 import asyncio
+import logging
+import logging.handlers
+import queue
 
 from core.config import settings
 
+# Log kayıtları kuyruğa atılır, yazma işini arka plandaki listener thread'i yapar;
+# böylece istek işleyen kod log I/O'sunda bloklanmaz.
+log_queue = queue.SimpleQueue()
+log_stream_handler = logging.StreamHandler()
+log_stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+log_listener = logging.handlers.QueueListener(log_queue, log_stream_handler, respect_handler_level=True)
+logging.basicConfig(level=logging.INFO, handlers=[logging.handlers.QueueHandler(log_queue)])
+log_listener.start()
+logger = logging.getLogger(__name__)
+
 try:
     cred = credentials.Certificate(settings.GOOGLE_APPLICATION_CREDENTIALS)
     if not firebase_admin._apps:
         firebase_admin.initialize_app(cred)
-    print("✅ Firebase Admin SDK başarıyla başlatıldı.")
+    logger.info("✅ Firebase Admin SDK başarıyla başlatıldı.")
 except Exception as e:
-    print(f"❌ Firebase Admin SDK başlatılırken hata oluştu: {e}")
+    logger.error("❌ Firebase Admin SDK başlatılırken hata oluştu: %s", e)
     raise e
 
 db = firestore.client()
@@ -25,39 +38,40 @@ from routers import auth, outfits, weather, users
 app = FastAPI(
     title="Combina API", 
     description="Fashion outfit suggestion API with unified user model",
-    version="2.1.0"
+    version="2.1.0",
+    default_response_class=ORJSONResponse
 )
 
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request: Request, exc: RequestValidationError):
-    print(f"\n❌ 422 VALIDATION ERROR at {request.url}")
-    print(f"❌ Method: {request.method}")
+    # Tüm ayrıntı tek bir kayıtta toplanır; eş zamanlı isteklerin satırları birbirine karışmaz
+    log_lines = [f"❌ 422 VALIDATION ERROR at {request.url}", f"❌ Method: {request.method}"]
     try:
         body = await request.body()
         if body:
-            body_str = body.decode('utf-8')
-            body_json = json.loads(body_str)
-            print(f"❌ Request body keys: {list(body_json.keys())}")
+            body_json = orjson.loads(body)
+            log_lines.append(f"❌ Request body keys: {list(body_json.keys())}")
             if 'wardrobe' in body_json and body_json['wardrobe']:
                 sample_item = body_json['wardrobe'][0]
-                print(f"❌ Sample wardrobe item keys: {list(sample_item.keys())}")
-                print(f"❌ Sample wardrobe item values:")
+                log_lines.append(f"❌ Sample wardrobe item keys: {list(sample_item.keys())}")
+                log_lines.append("❌ Sample wardrobe item values:")
                 for key, value in sample_item.items():
-                    print(f"      {key}: {type(value).__name__} = {value}")
+                    log_lines.append(f"      {key}: {type(value).__name__} = {value}")
             if 'context' in body_json:
-                print(f"❌ Context: {body_json['context']}")
+                log_lines.append(f"❌ Context: {body_json['context']}")
     except Exception as e:
-        print(f"❌ Could not parse request body: {e}")
+        log_lines.append(f"❌ Could not parse request body: {e}")
     
-    print(f"❌ VALIDATION ERRORS ({len(exc.errors())} total):")
+    log_lines.append(f"❌ VALIDATION ERRORS ({len(exc.errors())} total):")
     for i, error in enumerate(exc.errors()):
-        print(f"  Error {i+1}:")
-        print(f"     Field: {error.get('loc')}")
-        print(f"     Message: {error.get('msg')}")
-        print(f"     Type: {error.get('type')}")
-        print(f"     Input: {str(error.get('input', 'N/A'))[:100]}...")
-        print("     ---")
-    print("❌ END OF VALIDATION ERRORS\n")
+        log_lines.extend([
+            f"  Error {i+1}:",
+            f"     Field: {error.get('loc')}",
+            f"     Message: {error.get('msg')}",
+            f"     Type: {error.get('type')}",
+            f"     Input: {str(error.get('input', 'N/A'))[:100]}...",
+        ])
+    logger.warning("\n".join(log_lines))
     
     return JSONResponse(
         status_code=422,
@@ -109,11 +123,18 @@ app.include_router(users.webhook_router)
 
 @app.on_event("startup")
 async def startup_event():
-    print("🚀 Combina API starting up...")
-    print("✅ Guest user support enabled (as 'free' plan)")
-    print("✅ Authenticated user support enabled")
-    print("✅ Multi-language outfit suggestions ready")
+    logger.info("🚀 Combina API starting up...")
+    logger.info("✅ Guest user support enabled (as 'free' plan)")
+    logger.info("✅ Authenticated user support enabled")
+    logger.info("✅ Multi-language outfit suggestions ready")
     # --- DEĞİŞİKLİK: Anonymous cache temizleme ile ilgili tüm bölüm kaldırıldı ---
+    await outfits.warm_up_clients()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await outfits.close_clients()
+    await weather.close_client()
+    log_listener.stop()
 
 if __name__ == "__main__":
     uvicorn.run(
@@ -1,19 +1,26 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Request, Body
-from datetime import timedelta, datetime
+from datetime import timedelta
 from firebase_admin import firestore
 import requests
 import jwt
 import uuid
+import asyncio
+import logging
 from typing import Optional, Tuple
 from pydantic import BaseModel
 import secrets
 from core.security import create_access_token, get_current_user_id, require_authenticated_user
-from core.usage import get_or_create_daily_usage
+from core.usage import get_or_create_daily_usage, get_today_str
+from core.user_cache import invalidate_cached_user
 from core.config import settings
 from schemas import AnonymousSessionStart, AnonymousSessionResponse, UserProfileResponse
 
 router = APIRouter()
 db = firestore.client()
+logger = logging.getLogger(__name__)
+
+# Her girişte tekrar kurulmaması için sabit alanlar
+_USER_UPDATE_TEMPLATE = {"updatedAt": firestore.SERVER_TIMESTAMP, "is_anonymous": False}
 
 class GoogleAuthRequest(BaseModel):
     access_token: str
@@ -50,7 +57,7 @@ async def google_auth(request: GoogleAuthRequest):
         
         return {"access_token": access_token, "token_type": "bearer", "user_info": user_info}
     except Exception as e:
-        print(f"Google auth error: {e}")
+        logger.error("Google auth error: %s", e)
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Google authentication failed")
 
 @router.post("/auth/apple")
@@ -85,7 +92,7 @@ async def apple_auth(request: AppleAuthRequest):
         
         return {"access_token": access_token, "token_type": "bearer", "user_info": user_info}
     except Exception as e:
-        print(f"Apple auth error: {e}")
+        logger.error("Apple auth error: %s", e)
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Apple authentication failed.")
 
 @router.post("/auth/anonymous", response_model=AnonymousSessionResponse)
@@ -96,7 +103,7 @@ async def start_anonymous_session(request: Request, session_data: AnonymousSessi
 
     if user_id and user_id.startswith("anon_"):
         user_ref = db.collection('users').document(user_id)
-        user_doc = user_ref.get()
+        user_doc = await asyncio.to_thread(user_ref.get)
         if not user_doc.exists:
             user_id = None
     
@@ -112,8 +119,8 @@ async def start_anonymous_session(request: Request, session_data: AnonymousSessi
             "profile_complete": False, 
             "is_anonymous": True
         }
-        user_ref.set(user_data)
-        user_doc = user_ref.get()
+        await asyncio.to_thread(user_ref.set, user_data)
+        user_doc = await asyncio.to_thread(user_ref.get)
 
     user_info_dict = user_doc.to_dict()
     
@@ -122,7 +129,8 @@ async def start_anonymous_session(request: Request, session_data: AnonymousSessi
     is_profile_complete = bool(fullname and gender and gender != 'unisex')
 
     if user_info_dict.get("profile_complete") != is_profile_complete:
-         user_ref.update({"profile_complete": is_profile_complete})
+         await asyncio.to_thread(user_ref.update, {"profile_complete": is_profile_complete})
+         invalidate_cached_user(user_id)
 
     user_response = UserProfileResponse(
         user_id=user_id,
@@ -130,7 +138,7 @@ async def start_anonymous_session(request: Request, session_data: AnonymousSessi
         email=user_info_dict.get("email"),
         gender=user_info_dict.get("gender"),
         plan=user_info_dict.get("plan", "free"),
-        usage=get_or_create_daily_usage(user_id),
+        usage=await asyncio.to_thread(get_or_create_daily_usage, user_id),
         created_at=user_info_dict.get("createdAt"),
         isAnonymous=True,
         profile_complete=is_profile_complete
@@ -166,11 +174,22 @@ async def convert_anonymous_to_authenticated(
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="OAuth token and provider are required")
         
         guest_user_ref = db.collection('users').document(user_id)
-        guest_user_doc = guest_user_ref.get()
+
+        if provider == "google":
+            provider_lookup = get_google_user_info(oauth_token)
+        elif provider == "apple":
+            provider_lookup = verify_apple_token(oauth_token)
+        else:
+            raise HTTPException(status_code=400, detail="Unsupported provider")
+
+        # Misafir dokümanı ve sağlayıcı doğrulaması birbirinden bağımsız, paralel çalıştır
+        guest_user_doc, provider_user_info = await asyncio.gather(
+            asyncio.to_thread(guest_user_ref.get), provider_lookup
+        )
         guest_usage = guest_user_doc.to_dict().get("usage", {}) if guest_user_doc.exists else {}
         
         if provider == "google":
-            google_user_info = await get_google_user_info(oauth_token)
+            google_user_info = provider_user_info
             if not google_user_info:
                 raise HTTPException(status_code=401, detail="Invalid Google token")
             
@@ -180,8 +199,8 @@ async def convert_anonymous_to_authenticated(
                 provider='google', provider_id=google_user_info['id']
             )
         
-        elif provider == "apple":
-            apple_user_info = await verify_apple_token(oauth_token)
+        else:
+            apple_user_info = provider_user_info
             if not apple_user_info:
                 raise HTTPException(status_code=401, detail="Invalid Apple token")
 
@@ -193,17 +212,16 @@ async def convert_anonymous_to_authenticated(
                 provider='apple', provider_id=apple_user_info['sub']
             )
         
-        else:
-            raise HTTPException(status_code=400, detail="Unsupported provider")
-        
         if guest_usage.get("count", 0) > 0:
             user_ref = db.collection('users').document(new_user_id)
-            user_ref.update({
+            await asyncio.to_thread(user_ref.update, {
                 "usage": guest_usage,
                 "conversion_date": firestore.SERVER_TIMESTAMP
             })
 
-        guest_user_ref.delete()
+        await asyncio.to_thread(guest_user_ref.delete)
+        invalidate_cached_user(user_id)
+        invalidate_cached_user(new_user_id)
         
         access_token_expires = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
         access_token = create_access_token(data={"sub": new_user_id}, expires_delta=access_token_expires)
@@ -217,7 +235,7 @@ async def convert_anonymous_to_authenticated(
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Guest user conversion error: {e}")
+        logger.error("Guest user conversion error: %s", e)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed to convert guest user")
 
 @router.get("/auth/anonymous/status")
@@ -231,7 +249,7 @@ async def get_anonymous_status(
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="This endpoint is only for guest users")
     
     try:
-        usage_status = get_or_create_daily_usage(user_id)
+        usage_status = await asyncio.to_thread(get_or_create_daily_usage, user_id)
         
         return {
             "session_id": user_id, "plan": "free",
@@ -244,7 +262,7 @@ async def get_anonymous_status(
             "is_anonymous": True
         }
     except Exception as e:
-        print(f"Guest status error: {e}")
+        logger.error("Guest status error: %s", e)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed to get guest status")
 
 @router.post("/api/users/update-info")
@@ -254,7 +272,7 @@ async def update_user_info(
 ):
     try:
         user_ref = db.collection('users').document(user_id)
-        user_doc = user_ref.get()
+        user_doc = await asyncio.to_thread(user_ref.get)
         
         if not user_doc.exists:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
@@ -263,25 +281,27 @@ async def update_user_info(
             "fullname": request_data.name, "gender": request_data.gender,
             "updatedAt": firestore.SERVER_TIMESTAMP, "profile_incomplete": False
         }
-        user_ref.update(update_data)
+        await asyncio.to_thread(user_ref.update, update_data)
+        invalidate_cached_user(user_id)
         
         return {"message": "User info updated successfully", "profile_complete": True}
     except Exception as e:
-        print(f"Update user info error: {e}")
+        logger.error("Update user info error: %s", e)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed to update user info")
 
 async def get_google_user_info(access_token: str):
     try:
-        response = requests.get(f"https://www.googleapis.com/oauth2/v2/userinfo?access_token={access_token}")
+        # requests bloklayıcı; event loop'u (ve gather içindeki paralel işleri) tutmasın
+        response = await asyncio.to_thread(requests.get, f"https://www.googleapis.com/oauth2/v2/userinfo?access_token={access_token}")
         if response.status_code == 200: return response.json()
         return None
     except Exception as e:
-        print(f"Google API error: {e}")
+        logger.warning("Google API error: %s", e)
         return None
 
 async def verify_apple_token(identity_token: str):
     try:
-        apple_keys_response = requests.get("https://appleid.apple.com/auth/keys")
+        apple_keys_response = await asyncio.to_thread(requests.get, "https://appleid.apple.com/auth/keys")
         apple_keys = apple_keys_response.json()
         header = jwt.get_unverified_header(identity_token)
         for key in apple_keys['keys']:
@@ -293,42 +313,39 @@ async def verify_apple_token(identity_token: str):
                         issuer='https://appleid.apple.com'
                     )
                 except Exception as decode_error:
-                    print(f"Token decode error: {decode_error}")
+                    logger.warning("Token decode error: %s", decode_error)
                     continue
         return None
     except Exception as e:
-        print(f"Apple token verification error: {e}")
+        logger.warning("Apple token verification error: %s", e)
         return None
 
 async def create_or_update_user(uid: str, email: str, name: str, provider: str, provider_id: str):
     try:
         user_ref = db.collection('users').document(uid)
-        user_doc = user_ref.get()
+        user_doc = await asyncio.to_thread(user_ref.get)
         
         if not user_doc.exists:
             user_data = {
                 "email": email, "fullname": name, "provider": provider,
                 "provider_id": provider_id, "plan": "free",
                 "createdAt": firestore.SERVER_TIMESTAMP,
-                "usage": {"count": 0, "date": datetime.now().strftime("%Y-%m-%d"), "rewarded_count": 0},
+                "usage": {"count": 0, "date": get_today_str(), "rewarded_count": 0},
                 "is_anonymous": False
             }
             if name and len(name) > 1:
                 user_data["profile_incomplete"] = True
-            user_ref.set(user_data)
+            await asyncio.to_thread(user_ref.set, user_data)
         else:
             user_data = user_doc.to_dict()
-            update_data = {
-                "email": email, "provider": provider, "provider_id": provider_id,
-                "updatedAt": firestore.SERVER_TIMESTAMP,
-                "is_anonymous": False
-            }
+            update_data = {"email": email, "provider": provider, "provider_id": provider_id} | _USER_UPDATE_TEMPLATE
             if not user_data.get("fullname") and name:
                 update_data["fullname"] = name
-            user_ref.update(update_data)
+            await asyncio.to_thread(user_ref.update, update_data)
             user_data.update(update_data)
         
-        updated_doc = user_ref.get()
+        invalidate_cached_user(uid)
+        updated_doc = await asyncio.to_thread(user_ref.get)
         updated_data = updated_doc.to_dict()
         profile_complete = bool(updated_data.get("fullname") and updated_data.get("gender"))
         
@@ -339,5 +356,5 @@ async def create_or_update_user(uid: str, email: str, name: str, provider: str,
             "provider": provider, "profile_complete": profile_complete
         }
     except Exception as e:
-        print(f"Database error: {e}")
+        logger.error("Database error: %s", e)
         raise e
\ No newline at end of file
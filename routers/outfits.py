@@ -1,26 +1,50 @@
-from fastapi import APIRouter, Depends, HTTPException, Request
-from openai import OpenAI
-import json
-from datetime import date, datetime
-from firebase_admin import firestore
-from typing import List, Dict, Any, Tuple
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Request
+from fastapi.responses import ORJSONResponse
+from openai import AsyncOpenAI
+import orjson
+import httpx
+from firebase_admin import firestore, firestore_async
+from typing import Callable, List, Dict, Any, Optional, Tuple
 from urllib.parse import quote
-import traceback
 import asyncio
+import logging
+import random
 import time
+import hashlib
+import heapq
+from collections import Counter, defaultdict, deque
+from functools import lru_cache, partial
 
 from core.config import settings
 from core.security import get_current_user_id, require_authenticated_user
-from schemas import OutfitRequest, OutfitResponse, OptimizedClothingItem, SuggestedItem, PinterestLink
-from core import localization
+from schemas import OutfitRequest, OutfitResponse, OptimizedClothingItem, SuggestedItem
 from core.localization import SAME_OUTFIT_ERRORS
-from core.usage import PLAN_LIMITS
+from core.usage import PLAN_LIMITS, get_today_str
+from core import user_cache
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/api", tags=["outfits"])
 
-primary_client = OpenAI(api_key=settings.OPENAI_API_KEY)
-secondary_client = OpenAI(api_key=settings.OPENAI_API_KEY2)
-db = firestore.client()
+# Tüm API anahtarları aynı bağlantı havuzunu paylaşır; TLS el sıkışmaları istekler arasında yeniden kullanılır
+OPENAI_TIMEOUT = httpx.Timeout(30.0, connect=2.0)
+openai_http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=50, max_connections=200),
+    timeout=OPENAI_TIMEOUT,
+)
+OPENAI_API_KEYS = {
+    "primary": settings.OPENAI_API_KEY,
+    "secondary": settings.OPENAI_API_KEY2,
+    **{f"key{index}": key for index, key in enumerate(
+        filter(None, (key.strip() for key in settings.OPENAI_EXTRA_API_KEYS.split(","))), start=3
+    )},
+}
+openai_clients = {
+    name: AsyncOpenAI(api_key=key, http_client=openai_http_client, timeout=OPENAI_TIMEOUT)
+    for name, key in OPENAI_API_KEYS.items()
+}
+db = firestore_async.client()
 
 POPULAR_COLOR_COMBINATIONS = {
     "navy": {"colors": ["white", "beige", "mustard", "pink"], "effect": "Classic & Noble"},
@@ -86,126 +110,342 @@ def simplify_rules_for_client(rules_dict: Dict[str, Any]) -> Dict[str, Any]:
         }
     return simplified
 
+# Kurallar statik; her istekte yeniden sadeleştirmek yerine bir kez hesapla
+SIMPLIFIED_OCCASION_RULES = {
+    "female": simplify_rules_for_client(OCCASION_REQUIREMENTS_FEMALE),
+    "male": simplify_rules_for_client(OCCASION_REQUIREMENTS_MALE),
+}
+
+# (cinsiyet, etkinlik) -> kurallar; istek başına cinsiyete göre tablo seçmeden tek sözlük bakışı yapılır
+OCCASION_RULES: Dict[Tuple[str, str], Dict[str, Any]] = {
+    (gender, occasion): rules
+    for gender, requirements_map in (("female", OCCASION_REQUIREMENTS_FEMALE), ("male", OCCASION_REQUIREMENTS_MALE))
+    for occasion, rules in requirements_map.items()
+}
+
+# (cinsiyet, etkinlik) -> yasaklı kategoriler
+FORBIDDEN_CATEGORIES_BY_OCCASION: Dict[Tuple[str, str], frozenset] = {
+    key: frozenset(rules.get("forbidden_categories", ())) for key, rules in OCCASION_RULES.items()
+}
+NO_FORBIDDEN_CATEGORIES: frozenset = frozenset()
+
+# (cinsiyet, etkinlik) -> geçerli yapıların slot kümeleri ve hata mesajında önerilecek kategoriler
+OCCASION_STRUCTURE_SETS: Dict[Tuple[str, str], Tuple[Tuple[frozenset, ...], ...]] = {
+    key: tuple(tuple(frozenset(cats) for cats in struct.values()) for struct in rules["valid_structures"])
+    for key, rules in OCCASION_RULES.items() if rules.get("valid_structures")
+}
+OCCASION_SUGGESTED_CATEGORIES: Dict[Tuple[str, str], str] = {
+    key: ", ".join(sorted({cat for struct in structures for cats in struct for cat in cats}))
+    for key, structures in OCCASION_STRUCTURE_SETS.items()
+}
+
+# Kategori -> kurallarda yer aldığı slotlar (top, bottom, shoes...). Bir etkinliğin yapılarında bulunan
+# slotlara ait olup o etkinlikte hiçbir yapıda geçmeyen kategoriler seçilemez; prompt'a yazılmaz.
+def build_category_slots(occasion_rules: Dict[Tuple[str, str], Dict[str, Any]]) -> Dict[str, frozenset]:
+    category_slots: Dict[str, set] = defaultdict(set)
+    for rules in occasion_rules.values():
+        for struct in rules.get("valid_structures", ()):
+            for slot, cats in struct.items():
+                for cat in cats:
+                    category_slots[cat].add(slot)
+    return {cat: frozenset(slots) for cat, slots in category_slots.items()}
+
+CATEGORY_SLOTS = build_category_slots(OCCASION_RULES)
+
+OFF_STRUCTURE_CATEGORIES_BY_OCCASION: Dict[Tuple[str, str], frozenset] = {
+    key: frozenset(
+        cat for cat, slots in CATEGORY_SLOTS.items()
+        if slots <= {slot for struct in rules["valid_structures"] for slot in struct}
+        and not any(cat in cats for struct in rules["valid_structures"] for cats in struct.values())
+    )
+    for key, rules in OCCASION_RULES.items() if rules.get("valid_structures")
+}
+
+def rules_gender(gender: str) -> str:
+    """Kural tablolarında erkek dışındaki tüm cinsiyetler kadın kurallarını kullanır."""
+    return "male" if gender == "male" else "female"
+
+class GPTUnavailable(Exception):
+    """Tüm GPT anahtarlarının devresi açık; istek yeniden denenmeden reddedilir."""
+
 class GPTLoadBalancer:
-    def __init__(self): 
-        self.primary_failures, self.secondary_failures = 0, 0
-        self.last_primary_use, self.last_secondary_use = 0, 0
-        self.max_failures, self.failure_reset_time = 3, 300
+    """
+    N anahtar arasında "power of two choices" ile seçim yapar: devrede olan anahtarlardan rastgele
+    ikisi alınır, (devam eden istek + 1) * EWMA gecikmesi * (1 + son failure_window saniyedeki hata)
+    değeri düşük olan kullanılır.
+    Art arda max_failures hata veren anahtarın devresi açılır; açık kalma süresi her yeni açılışta
+    ikiye katlanır (circuit_open_time'dan max_circuit_open_time'a kadar). Süre dolunca anahtar
+    yarı açık olur ve tek bir deneme isteği alır: başarılıysa devre kapanır, başarısızsa hemen
+    tekrar açılır. Deneme isteği get_available_client'tan is_probe=True ile döner; devre durumunu
+    yalnızca o isteğin sonucu değiştirir. Hiçbir anahtar kullanılamıyorsa GPTUnavailable fırlatılır.
+    Metotlarda await olmadığı için event loop üzerinde her çağrı bölünmeden çalışır; ek kilide gerek yoktur.
+    """
+    EWMA_ALPHA = 0.1
+    
+    def __init__(self, clients: Dict[str, AsyncOpenAI]):
+        self.clients = clients
+        self.state = {
+            name: {
+                "failures": 0, "ewma_ms": 0.0, "inflight": 0, "open_until": 0.0, "recent_failures": deque(),
+                "trips": 0, "probing": False
+            }
+            for name in clients
+        }
+        self.max_failures, self.failure_window = 5, 300
+        self.circuit_open_time, self.max_circuit_open_time = 60, 300
+    
+    def is_available(self, client_type: str) -> bool:
+        client_state = self.state[client_type]
+        if client_state["open_until"] > time.monotonic():
+            return False
+        # Yarı açık anahtar aynı anda yalnızca bir deneme isteği alır
+        return not (client_state["trips"] and client_state["probing"])
+    
+    def recent_failure_count(self, client_type: str) -> int:
+        recent_failures = self.state[client_type]["recent_failures"]
+        window_start = time.monotonic() - self.failure_window
+        while recent_failures and recent_failures[0] < window_start:
+            recent_failures.popleft()
+        return len(recent_failures)
     
-    def get_available_client(self):
-        current_time = time.time()
-        if current_time - self.last_primary_use > self.failure_reset_time: self.primary_failures = 0
-        if current_time - self.last_secondary_use > self.failure_reset_time: self.secondary_failures = 0
-        if self.primary_failures < self.max_failures: self.last_primary_use = current_time; return primary_client, "primary"
-        elif self.secondary_failures < self.max_failures: self.last_secondary_use = current_time; return secondary_client, "secondary"
-        else: self.primary_failures = 0; self.last_primary_use = current_time; return primary_client, "primary"
+    def _load(self, client_type: str) -> float:
+        client_state = self.state[client_type]
+        # Henüz ölçülmemiş anahtar 1 ms sayılır; böylece hata sayısı yine de ağırlığı etkiler
+        return ((client_state["inflight"] + 1) * max(client_state["ewma_ms"], 1.0)
+                * (1 + self.recent_failure_count(client_type)))
     
-    def report_failure(self, client_type: str):
-        if client_type == "primary": self.primary_failures += 1
-        else: self.secondary_failures += 1
+    def get_available_client(self, exclude: Optional[str] = None) -> Tuple[AsyncOpenAI, str, bool]:
+        available = [name for name in self.state if self.is_available(name)]
+        # Tek anahtar kaldıysa hedge isteği de aynı anahtara gider
+        candidates = [name for name in available if name != exclude] or available
+        if not candidates:
+            raise GPTUnavailable("All GPT clients are temporarily disabled")
+        client_type = min(random.sample(candidates, min(2, len(candidates))), key=self._load)
+        client_state = self.state[client_type]
+        client_state["inflight"] += 1
+        is_probe = bool(client_state["trips"])
+        if is_probe:
+            client_state["probing"] = True
+        return self.clients[client_type], client_type, is_probe
     
-    def report_success(self, client_type: str):
-        if client_type == "primary": self.primary_failures = max(0, self.primary_failures - 1)
-        else: self.secondary_failures = max(0, self.secondary_failures - 1)
+    def release(self, client_type: str, is_probe: bool = False) -> None:
+        """Sonucu beklenmeden iptal edilen istek için ayrılan slotu geri bırakır."""
+        client_state = self.state[client_type]
+        client_state["inflight"] = max(0, client_state["inflight"] - 1)
+        if is_probe:
+            client_state["probing"] = False
+    
+    def report_failure(self, client_type: str, is_probe: bool = False):
+        client_state = self.state[client_type]
+        self.release(client_type, is_probe)
+        client_state["failures"] += 1
+        client_state["recent_failures"].append(time.monotonic())
+        if is_probe or client_state["failures"] >= self.max_failures:
+            open_time = min(self.max_circuit_open_time, self.circuit_open_time * 2 ** client_state["trips"])
+            client_state["open_until"] = time.monotonic() + open_time
+            client_state["trips"] += 1
+            client_state["failures"] = 0
+    
+    def report_success(self, client_type: str, latency_ms: Optional[float] = None, is_probe: bool = False):
+        self.release(client_type, is_probe)
+        client_state = self.state[client_type]
+        client_state["failures"] = 0
+        # Devre açılmadan önce başlamış bir isteğin başarısı yarı açık devreyi kapatmaz
+        if is_probe:
+            client_state["trips"] = 0
+        if latency_ms is not None:
+            ewma = client_state["ewma_ms"]
+            client_state["ewma_ms"] = latency_ms if ewma == 0 else (1 - self.EWMA_ALPHA) * ewma + self.EWMA_ALPHA * latency_ms
+
+gpt_balancer = GPTLoadBalancer(openai_clients)
+
+async def warm_up_clients() -> None:
+    """Firestore kanalını ve OpenAI bağlantı havuzunu ilk istekten önce ısıtır."""
+    async def _warm(name: str, coro) -> None:
+        try:
+            await coro
+        except Exception as e:
+            logger.warning("⚠️ %s warm-up failed: %s", name, e)
+    
+    await asyncio.gather(
+        _warm("Firestore", db.collection('users').limit(1).get()),
+        _warm("OpenAI", openai_clients["primary"].models.list()),
+    )
+
+async def close_clients() -> None:
+    await usage_write_buffer.drain()
+    await openai_http_client.aclose()
+
+# Prompt'a gönderilecek gardırop bu boyutu aşarsa kategori başına kırpılır
+PROMPT_WARDROBE_LIMIT = 80
+PROMPT_ITEMS_PER_CATEGORY = 12
+PROMPT_MIN_FOCUSED_ITEMS = 8
+
+WEATHER_SEASONS = {
+    "hot": frozenset({"summer"}),
+    "sunny": frozenset({"summer", "spring"}),
+    "warm": frozenset({"summer", "spring"}),
+    "mild": frozenset({"spring", "fall", "autumn"}),
+    "cool": frozenset({"fall", "autumn", "spring"}),
+    "windy": frozenset({"fall", "autumn", "spring"}),
+    "rainy": frozenset({"fall", "autumn", "spring"}),
+    "cold": frozenset({"winter", "fall", "autumn"}),
+    "snowy": frozenset({"winter"}),
+}
 
-gpt_balancer = GPTLoadBalancer()
+# Prompt sırası: önce sabit talimatlar ve yanıt şeması, sonra kullanıcının gardırobu, en sonda değişken
+# kısımlar (ör. kaçınılacak ID'ler). Ortak önek uzadıkça OpenAI'nin prompt önbelleği daha çok işe yarar.
+PROMPT_HEADER = """
+You are an expert fashion stylist...
+"""
+
+ITEM_DATABASE_HEADER = """
+ITEM DATABASE (one item per line: id|name|category|colors(;-separated)):
+"""
+
+@lru_cache(maxsize=8)
+def _prompt_response_section(plan: str) -> str:
+    pinterest_instructions = ""
+    if plan == "premium":
+        pinterest_instructions = ''',"pinterest_links": [ ... ]'''
+    return f"""JSON RESPONSE STRUCTURE:
+{{ "items": [...], "description": "...", "suggestion_tip": "..." {pinterest_instructions} }}
+"""
+
+@lru_cache(maxsize=8)
+def _prompt_static_prefix(plan: str) -> str:
+    """Gardıroptan önceki, plan dışında değişmeyen kısım; plan başına bir kez birleştirilir."""
+    return "".join([PROMPT_HEADER, _prompt_response_section(plan), ITEM_DATABASE_HEADER])
+
+@lru_cache(maxsize=8192)
+def _compact_wardrobe_row(item_id: str, name: str, category: str, colors: Tuple[str, ...]) -> str:
+    # Aynı kullanıcı tekrar istek attığında satırlar yeniden biçimlendirilmez
+    return f"{item_id}|{name}|{category}|{';'.join(colors)}"
 
 class AdvancedOutfitEngine:
     def check_wardrobe_compatibility(self, occasion: str, wardrobe: List[OptimizedClothingItem], gender: str):
-        requirements_map = OCCASION_REQUIREMENTS_MALE if gender == 'male' else OCCASION_REQUIREMENTS_FEMALE
-        if occasion not in requirements_map: return
-        
-        occasion_rules = requirements_map[occasion]
-        valid_structures = occasion_rules.get("valid_structures", [])
-        if not valid_structures: return
+        rules_key = (rules_gender(gender), occasion)
+        structure_sets = OCCASION_STRUCTURE_SETS.get(rules_key)
+        if not structure_sets: return
         
         wardrobe_categories = {item.category for item in wardrobe}
         can_create_any_structure = any(
-            all(wardrobe_categories.intersection(req_cats) for _, req_cats in struct.items()) 
-            for struct in valid_structures
+            all(not wardrobe_categories.isdisjoint(slot) for slot in struct) for struct in structure_sets
         )
         
         if not can_create_any_structure:
-            all_possible_categories = {
-                cat for struct in valid_structures 
-                for cats in struct.values() for cat in cats
-            }
-            error_detail = f"Your wardrobe is not suitable for '{occasion}'. Please add appropriate items like: {', '.join(sorted(list(all_possible_categories)))}."
+            error_detail = f"Your wardrobe is not suitable for '{occasion}'. Please add appropriate items like: {OCCASION_SUGGESTED_CATEGORIES[rules_key]}."
             raise HTTPException(status_code=422, detail=error_detail)
 
+    def prefilter_wardrobe(self, wardrobe: List[OptimizedClothingItem], weather_condition: str) -> List[OptimizedClothingItem]:
+        """
+        Büyük gardıroplarda prompt'a girecek parça sayısını sınırlar: her kategoride
+        hava durumuna uyan sezonlardaki parçaları öne alıp en fazla PROMPT_ITEMS_PER_CATEGORY tutar.
+        Her kategori temsil edilmeye devam eder, orijinal sıra korunur.
+        """
+        if len(wardrobe) <= PROMPT_WARDROBE_LIMIT:
+            return wardrobe
+        
+        preferred_seasons = WEATHER_SEASONS.get(weather_condition.lower(), frozenset())
+        by_category: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        for index, item in enumerate(wardrobe):
+            score = 0 if preferred_seasons.isdisjoint(item.season) else 1
+            by_category[item.category].append((score, -index))
+        
+        kept_indexes = {
+            -neg_index
+            for entries in by_category.values()
+            for _, neg_index in heapq.nlargest(PROMPT_ITEMS_PER_CATEGORY, entries)
+        }
+        return [item for index, item in enumerate(wardrobe) if index in kept_indexes]
+
     def create_compact_wardrobe_string(self, wardrobe: List[OptimizedClothingItem]) -> str:
-        return "\n".join([
-            f"i:{item.id},n:{item.name},c:{item.category},cl:{';'.join(item.colors)},st:{';'.join(item.style)}" 
+        # Stiller her satırda tekrarlanmak yerine gardırop düzeyinde tek satırda verilir
+        rows = "\n".join(
+            _compact_wardrobe_row(item.id, item.name, item.category, tuple(item.colors))
             for item in wardrobe
-        ])
-
-    def create_advanced_prompt(self, request: OutfitRequest, recent_outfits: List[Dict[str, Any]]) -> str:
-        lang_code, gender = request.language, request.gender
-        target_language = localization.LANGUAGE_NAMES.get(lang_code, "English")
-        en_occasions = localization.get_translation('en', 'occasions')
-        occasion_text = en_occasions.get(request.occasion, request.occasion.replace('-', ' '))
-        
-        avoid_combos_str = "\n".join([
-            f"- Combo {i+1}: {', '.join(outfit_map.get('items', []))}" 
-            for i, outfit_map in enumerate(recent_outfits) if outfit_map.get('items')
-        ]) or "None"
-        
-        popular_combos_text = "\n".join([
-            f"- For a '{details['effect']}' look, combine '{color.capitalize()}' with: {', '.join(details['colors'])}." 
-            for color, details in POPULAR_COLOR_COMBINATIONS.items() if details['colors'] != "any"
-        ])
-        popular_combos_text += "\n- Denim Blue is a 'Joker' (versatile) piece and works with almost any color."
-        
-        pinterest_instructions = ""
-        if request.plan == "premium":
-            pinterest_instructions = f''',"pinterest_links": [ ... ]'''
-        
-        return f"""
-You are an expert fashion stylist...
-ITEM DATABASE (Format: i=id, n=name, c=category, cl=colors(;-separated), st=styles(;-separated)):
-{self.create_compact_wardrobe_string(request.wardrobe)}
-JSON RESPONSE STRUCTURE:
-{{ "items": [...], "description": "...", "suggestion_tip": "..." {pinterest_instructions} }}"""
+        )
+        wardrobe_styles = sorted({style for item in wardrobe for style in item.style})
+        return f"Styles in wardrobe: {', '.join(wardrobe_styles)}\n{rows}" if wardrobe_styles else rows
 
-    def validate_outfit_structure(self, items_from_ai: List[Dict[str, str]], wardrobe: List[OptimizedClothingItem]) -> List[SuggestedItem]:
+    def create_advanced_prompt(self, request: OutfitRequest) -> str:
+        # Son kombinler prompt'a yazılmıyor (tekrar kontrolü yanıt üzerinde yapılıyor);
+        # bu yüzden istek başına "avoid combos" metni de üretilmiyor.
+        return _prompt_static_prefix(request.plan) + self.create_compact_wardrobe_string(request.wardrobe)
+
+    def validate_outfit_structure(self, items_from_ai: List[Dict[str, str]], wardrobe_map: Dict[str, OptimizedClothingItem]) -> List[SuggestedItem]:
         if not items_from_ai or not isinstance(items_from_ai, list): return []
-        wardrobe_map = {item.id: item for item in wardrobe}
-        return [
-            SuggestedItem(**item) for item in items_from_ai 
-            if isinstance(item, dict) and item.get("id") in wardrobe_map
-        ]
+        # Ad ve kategori gardıroptaki kayıttan alınır; id'si bulunmayan veya bozuk öğeler atlanır.
+        # Alanlar istek modelinde zaten doğrulandığı için SuggestedItem yeniden doğrulanmadan kurulur.
+        validated_items = []
+        for item in items_from_ai:
+            try:
+                original = wardrobe_map[item["id"]]
+            except (KeyError, TypeError, IndexError):
+                continue
+            validated_items.append(SuggestedItem.model_construct(id=original.id, name=original.name, category=original.category))
+        return validated_items
 
 outfit_engine = AdvancedOutfitEngine()
 
+async def fetch_user_data(user_id: str) -> Optional[Dict[str, Any]]:
+    """Kullanıcı dokümanını önce süreç içi cache'ten, yoksa Firestore'dan okur."""
+    user_data_dict = user_cache.get_cached_user(user_id)
+    if user_data_dict is not None:
+        return user_data_dict
+    
+    async with user_cache.get_user_lock(user_id):
+        user_data_dict = user_cache.get_cached_user(user_id)
+        if user_data_dict is not None:
+            return user_data_dict
+        
+        # Uçuştaki kullanım yazıları önce tamamlanır ki okunan sayaçla çift sayılmasın
+        await usage_write_buffer.wait_for_commits(user_id)
+        user_doc = await db.collection('users').document(user_id).get()
+        if not user_doc.exists:
+            return None
+        
+        user_data_dict = user_doc.to_dict()
+        user_cache.set_cached_user(user_id, user_data_dict)
+        return user_data_dict
+
+PINTEREST_SEARCH_URL = "https://www.pinterest.com/search/pins/?q="
+
+# Tekrar kontrolü ve Firestore'da saklanan geçmiş için tutulan son kombin sayısı
+RECENT_OUTFITS_LIMIT = 5
+
 async def check_usage_and_get_user_data(
     request: Request,
     user_data_tuple: Tuple[str, bool] = Depends(get_current_user_id)
 ) -> Dict[str, Any]:
     user_id, is_anonymous = user_data_tuple
-    today = str(date.today())
+    today = get_today_str()
     
-    print(f"🔄 Processing {'guest' if is_anonymous else 'authenticated'} user: {user_id[:16]}...")
+    logger.debug("🔄 Processing %s user: %s...", 'guest' if is_anonymous else 'authenticated', user_id[:16])
     
-    user_ref = db.collection('users').document(user_id)
-    user_doc = user_ref.get()
+    user_data_dict = await fetch_user_data(user_id)
     
-    if not user_doc.exists:
+    if user_data_dict is None:
         raise HTTPException(status_code=404, detail="User profile not found.")
     
-    user_data_dict = user_doc.to_dict()
     plan = user_data_dict.get("plan", "free")
     usage_data = user_data_dict.get("usage", {})
     
+    # Gün değiştiyse sayaç yalnızca bellekte sıfırlanır; Firestore'a ayrı bir yazı atılmaz,
+    # sıfırlama suggest_outfit'in hak ayırma yazısıyla birlikte gider.
+    usage_reset_date = None
     if usage_data.get("date") != today:
         usage_data = {"count": 0, "date": today, "rewarded_count": 0}
-        user_ref.update({"usage": usage_data})
+        user_cache.update_cached_user(user_id, {"usage": usage_data})
+        usage_reset_date = today
     
     user_info = {
         "user_id": user_id,
         "gender": user_data_dict.get("gender", "unisex"),
         "plan": plan,
-        "recent_outfits": user_data_dict.get("recent_outfits", []),
-        "is_anonymous": is_anonymous
+        "recent_outfits": user_data_dict.get("recent_outfits", [])[:RECENT_OUTFITS_LIMIT],
+        "is_anonymous": is_anonymous,
+        "usage_reset_date": usage_reset_date
     }
     
     if plan == "premium":
@@ -217,74 +457,608 @@ async def check_usage_and_get_user_data(
     
     return user_info
 
-async def call_gpt_with_retry(prompt: str, plan: str, attempt: int = 1, max_retries: int = 2) -> str:
+def _outfit_response_format(include_pinterest: bool) -> Dict[str, Any]:
+    """
+    Plan başına sabit, strict JSON şeması. Kombin öğelerinde yalnızca id istenir; ad ve kategori
+    sunucuda gardıroptan alınır. Şema isteğe göre değişmediği için OpenAI tarafında bir kez derlenir.
+    """
+    properties: Dict[str, Any] = {
+        "items": {
+            "type": "array",
+            "items": {
+                "type": "object", "properties": {"id": {"type": "string"}},
+                "required": ["id"], "additionalProperties": False
+            }
+        },
+        "description": {"type": "string"},
+        "suggestion_tip": {"type": "string"},
+    }
+    if include_pinterest:
+        properties["pinterest_links"] = {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"title": {"type": "string"}, "search_query": {"type": "string"}},
+                "required": ["title", "search_query"], "additionalProperties": False
+            }
+        }
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "outfit_suggestion", "strict": True,
+            "schema": {"type": "object", "properties": properties, "required": list(properties), "additionalProperties": False}
+        }
+    }
+
+# Toplu isteklerde yanıt {"results": [...]} biçiminde olduğu için serbest JSON modu kullanılır
+BATCH_RESPONSE_FORMAT = {"type": "json_object"}
+
+GPT_CONFIG_BY_PLAN = {
+    "free": {"max_tokens": 900, "response_format": _outfit_response_format(include_pinterest=False)}, 
+    "premium": {"max_tokens": 1300, "response_format": _outfit_response_format(include_pinterest=True)},
+}
+
+GPT_RETRY_BASE_DELAY = 0.25  # saniye; her yeni denemede üst sınır ikiye katlanır
+GPT_RETRY_MAX_DELAY = 4.0  # saniye; Retry-After dahil kullanıcıyı bundan uzun bekletme
+GPT_HEDGE_DELAY = 1.5  # saniye; bu süre içinde ilk token gelmezse diğer anahtarla yarıştır
+
+class UnusableGPTResponse(Exception):
+    """Yanıt stream edilirken kullanılamaz olduğu anlaşılan (ör. gardıropta olmayan ID'ler) GPT çıktısı."""
+
+class _ItemsArrayScanner:
+    """
+    Stream edilen JSON metninde üst seviyedeki "items" dizisinin kapandığı anı yakalar;
+    böylece yanıtın geri kalanı gelmeden parçalar doğrulanabilir.
+    """
+    def __init__(self):
+        self.text, self.position = "", 0
+        self.depth, self.in_string, self.escaped = 0, False, False
+        self.string_start, self.last_key = 0, None
+        self.items_start, self.done = None, False
+    
+    def feed(self, chunk: str) -> Optional[List[Any]]:
+        if self.done:
+            return None
+        self.text += chunk
+        text = self.text
+        for index in range(self.position, len(text)):
+            char = text[index]
+            if self.in_string:
+                if self.escaped: self.escaped = False
+                elif char == "\\": self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                    if self.depth == 1: self.last_key = text[self.string_start + 1:index]
+            elif char == '"':
+                self.in_string, self.string_start = True, index
+            elif char in "{[":
+                if char == "[" and self.depth == 1 and self.last_key == "items": self.items_start = index
+                self.depth += 1
+            elif char in "}]":
+                self.depth -= 1
+                if self.depth == 1 and self.items_start is not None:
+                    self.done = True
+                    try:
+                        return orjson.loads(text[self.items_start:index + 1])
+                    except orjson.JSONDecodeError:
+                        return None
+        self.position = len(text)
+        return None
+
+async def _create_completion(
+    client: AsyncOpenAI, prompt: str, gpt_config: Dict[str, Any], first_token: Optional[asyncio.Event] = None,
+    items_check: Optional[Callable[[List[Any]], None]] = None
+) -> Dict[str, Any]:
+    """
+    Yanıtı stream olarak alır; ilk içerik parçası geldiğinde `first_token` set edilir.
+    `items_check`, "items" dizisi tamamlanır tamamlanmaz çağrılır; UnusableGPTResponse
+    fırlatırsa stream kapatılır ve yanıtın kalanı beklenmez.
+    """
+    stream = await client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=[
+            {"role": "system", "content": "You are an expert fashion stylist. Always respond with valid JSON."},
+            {"role": "user", "content": prompt}
+        ],
+        stream=True,
+        **gpt_config
+    )
+    
+    content_parts: List[str] = []
+    items_scanner = _ItemsArrayScanner() if items_check is not None else None
+    try:
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta_content = chunk.choices[0].delta.content
+            if delta_content:
+                if first_token is not None and not first_token.is_set():
+                    first_token.set()
+                content_parts.append(delta_content)
+                if items_scanner is not None:
+                    streamed_items = items_scanner.feed(delta_content)
+                    if streamed_items is not None:
+                        items_check(streamed_items)
+    finally:
+        await stream.close()
+    
+    response_content = "".join(content_parts)
+    if not response_content:
+        raise ValueError("Empty response from GPT")
+    
+    # Yanıt burada bir kez parse edilir; çağıranlar sözlüğü doğrudan kullanır
+    parsed_response = orjson.loads(response_content)
+    if not isinstance(parsed_response, dict):
+        raise ValueError("GPT response is not a JSON object")
+    return parsed_response
+
+async def _hedged_completion(
+    prompt: str, gpt_config: Dict[str, Any], items_check: Optional[Callable[[List[Any]], None]] = None
+) -> Dict[str, Any]:
+    """
+    Önce balancer'ın seçtiği istemciyi çağırır; GPT_HEDGE_DELAY içinde ilk token gelmezse
+    başka bir anahtarla ikinci isteği de başlatır, ilk başarılı yanıtı döndürür ve kalanı iptal eder.
+    """
+    client, client_type, is_probe = gpt_balancer.get_available_client()
+    first_token = asyncio.Event()
+    tasks = {
+        asyncio.create_task(_create_completion(client, prompt, gpt_config, first_token, items_check)):
+            (client_type, time.monotonic(), is_probe)
+    }
+    
+    last_error: Exception = RuntimeError("No GPT response")
+    try:
+        first_token_waiter = asyncio.create_task(first_token.wait())
+        try:
+            done, _ = await asyncio.wait(
+                {*tasks, first_token_waiter}, timeout=GPT_HEDGE_DELAY, return_when=asyncio.FIRST_COMPLETED
+            )
+        finally:
+            first_token_waiter.cancel()
+        
+        if not done:
+            try:
+                hedge_client, hedge_type, hedge_is_probe = gpt_balancer.get_available_client(exclude=client_type)
+            except GPTUnavailable:
+                logger.debug("⏱️ %s GPT client slow, no client left to hedge with", client_type)
+            else:
+                logger.debug("⏱️ %s GPT client slow, hedging with %s", client_type, hedge_type)
+                tasks[asyncio.create_task(_create_completion(hedge_client, prompt, gpt_config, items_check=items_check))] = (
+                    hedge_type, time.monotonic(), hedge_is_probe
+                )
+        
+        while tasks:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                finished_type, started_at, finished_is_probe = tasks.pop(task)
+                if task.exception() is None:
+                    gpt_balancer.report_success(
+                        finished_type, (time.monotonic() - started_at) * 1000, is_probe=finished_is_probe
+                    )
+                    return task.result()
+                if isinstance(task.exception(), UnusableGPTResponse):
+                    # Anahtar sağlıklı; sorun içerikte, yeniden denemenin anlamı yok
+                    gpt_balancer.report_success(finished_type, is_probe=finished_is_probe)
+                    raise task.exception()
+                gpt_balancer.report_failure(finished_type, is_probe=finished_is_probe)
+                last_error = task.exception()
+                logger.warning("❌ GPT API error with %s: %s", finished_type, last_error)
+        raise last_error
+    finally:
+        for task, (pending_type, _, pending_is_probe) in tasks.items():
+            task.cancel()
+            gpt_balancer.release(pending_type, pending_is_probe)
+
+def _retry_delay(error: Exception, retry_index: int) -> float:
+    """Tam jitter'lı üstel bekleme; 429 gibi yanıtlarda Retry-After başlığı varsa ona uyulur."""
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return min(GPT_RETRY_MAX_DELAY, max(0.0, float(retry_after)))
+        except ValueError:
+            pass
+    return random.uniform(0, min(GPT_RETRY_MAX_DELAY, GPT_RETRY_BASE_DELAY * 2 ** retry_index))
+
+async def call_gpt_with_retry(
+    prompt: str, plan: str, attempt: int = 1, max_retries: int = 2, batch_size: int = 1,
+    items_check: Optional[Callable[[List[Any]], None]] = None
+) -> Dict[str, Any]:
     base_temp = 0.7
     current_temp = min(base_temp + (0.1 * (attempt - 1)), 1.0)
     
-    config = {
-        "free": {"max_tokens": 900}, 
-        "premium": {"max_tokens": 1300},
-    }
-    gpt_config = config.get(plan, config["free"])
-    gpt_config["temperature"] = current_temp
+    plan_config = GPT_CONFIG_BY_PLAN.get(plan, GPT_CONFIG_BY_PLAN["free"])
+    gpt_config = {**plan_config, "max_tokens": plan_config["max_tokens"] * batch_size, "temperature": current_temp}
+    if batch_size > 1:
+        gpt_config["response_format"] = BATCH_RESPONSE_FORMAT
     
     for i in range(max_retries + 1):
-        client, client_type = gpt_balancer.get_available_client()
         try:
-            print(f"📡 Calling GPT (Attempt: {i+1}, Temp: {current_temp}, Plan: {plan})...")
-            completion = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "You are an expert fashion stylist. Always respond with valid JSON."},
-                    {"role": "user", "content": prompt}
-                ],
-                response_format={"type": "json_object"},
-                **gpt_config
-            )
-            
-            response_content = completion.choices[0].message.content
-            if not response_content:
-                raise ValueError("Empty response from GPT")
-            
-            json.loads(response_content)
-            gpt_balancer.report_success(client_type)
-            return response_content
-            
+            logger.debug("📡 Calling GPT (Attempt: %d, Temp: %s, Plan: %s)...", i + 1, current_temp, plan)
+            return await _hedged_completion(prompt, gpt_config, items_check)
+        except (UnusableGPTResponse, GPTUnavailable):
+            raise
         except Exception as e:
-            print(f"❌ GPT API error on attempt {i + 1} with {client_type}: {str(e)}")
-            gpt_balancer.report_failure(client_type)
             if i < max_retries:
-                await asyncio.sleep(1)
+                await asyncio.sleep(_retry_delay(e, i))
             else:
                 raise e
 
+GPT_BATCH_WINDOW = 0.05  # saniye
+GPT_BATCH_MAX_SIZE = 4
+
+BATCH_PROMPT_HEADER = """You will receive {count} independent outfit requests, each starting with '### QUERY <n>'.
+Solve every query on its own, using only the items from that query's ITEM DATABASE.
+Respond with a JSON object of the form {{"results": [...]}} containing exactly {count} entries in query order,
+each entry following that query's JSON RESPONSE STRUCTURE.
+"""
+
+class GPTRequestBatcher:
+    """
+    GPT_BATCH_WINDOW içinde gelen ve aynı plan/denemeye ait istekleri tek bir GPT çağrısında toplar.
+    Toplu yanıt beklenen biçimde gelmezse istekler tek tek gönderilir.
+    """
+    def __init__(self, window: float, max_size: int):
+        self.window, self.max_size = window, max_size
+        self.pending: Dict[Tuple[str, int], List[Tuple[str, asyncio.Future]]] = {}
+        self.flush_handles: Dict[Tuple[str, int], asyncio.TimerHandle] = {}
+        self.running_batches: set = set()
+    
+    async def submit(self, prompt: str, plan: str, attempt: int) -> Dict[str, Any]:
+        loop = asyncio.get_running_loop()
+        key = (plan, attempt)
+        future = loop.create_future()
+        batch = self.pending.setdefault(key, [])
+        batch.append((prompt, future))
+        if len(batch) >= self.max_size:
+            self._flush(key)
+        elif len(batch) == 1:
+            self.flush_handles[key] = loop.call_later(self.window, self._flush, key)
+        return await future
+    
+    def _flush(self, key: Tuple[str, int]) -> None:
+        handle = self.flush_handles.pop(key, None)
+        if handle is not None:
+            handle.cancel()
+        batch = self.pending.pop(key, [])
+        if batch:
+            task = asyncio.create_task(self._run_batch(key, batch))
+            self.running_batches.add(task)
+            task.add_done_callback(self.running_batches.discard)
+    
+    async def _run_single(self, prompt: str, future: asyncio.Future, plan: str, attempt: int) -> None:
+        try:
+            result = await call_gpt_with_retry(prompt, plan, attempt=attempt)
+        except Exception as e:
+            if not future.done(): future.set_exception(e)
+        else:
+            if not future.done(): future.set_result(result)
+    
+    async def _run_batch(self, key: Tuple[str, int], batch: List[Tuple[str, asyncio.Future]]) -> None:
+        plan, attempt = key
+        batch = [(prompt, future) for prompt, future in batch if not future.done()]
+        if len(batch) == 1:
+            await self._run_single(batch[0][0], batch[0][1], plan, attempt)
+            return
+        if not batch:
+            return
+        
+        batched_prompt = BATCH_PROMPT_HEADER.format(count=len(batch)) + "\n".join(
+            f"### QUERY {index}\n{prompt}" for index, (prompt, _) in enumerate(batch, start=1)
+        )
+        try:
+            batch_response = await call_gpt_with_retry(batched_prompt, plan, attempt=attempt, batch_size=len(batch))
+            results = batch_response.get("results")
+            if (not isinstance(results, list) or len(results) != len(batch)
+                    or not all(isinstance(result, dict) for result in results)):
+                raise ValueError("Batched GPT response does not match the number of queries")
+        except Exception as e:
+            logger.warning("⚠️ Batched GPT call failed (%s), falling back to single calls", e)
+            await asyncio.gather(*(self._run_single(prompt, future, plan, attempt) for prompt, future in batch))
+            return
+        
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+gpt_batcher = GPTRequestBatcher(GPT_BATCH_WINDOW, GPT_BATCH_MAX_SIZE)
+
+GPT_INFLIGHT: Dict[str, asyncio.Future] = {}  # çağrı anahtarı -> süren çağrının sonucu
+
+def recent_outfits_fingerprint(recent_outfits: List[Dict[str, Any]]) -> str:
+    return ";".join(",".join(sorted(outfit.get("items", []))) for outfit in recent_outfits)
+
+def build_gpt_call_key(
+    request: OutfitRequest, user_info: Dict[str, Any], wardrobe_fingerprint: str, prompt: str, attempt: int
+) -> str:
+    """
+    İstek bağlamı, gardırop ve son kombin parmak izleri ile prompt'tan kararlı bir anahtar üretir.
+    Son kombinler prompt'a yazılmadığı için ayrıca anahtara eklenir; yalnızca aynı bağlamdaki
+    eş zamanlı istekler tek GPT çağrısını paylaşır.
+    """
+    raw_key = "|".join([
+        user_info["gender"], request.occasion, request.weather_condition, request.language,
+        user_info["plan"], str(attempt), wardrobe_fingerprint,
+        recent_outfits_fingerprint(user_info["recent_outfits"]), prompt
+    ])
+    return hashlib.blake2b(raw_key.encode("utf-8"), digest_size=16).hexdigest()
+
+async def shared_gpt_completion(
+    prompt: str, plan: str, call_key: str, attempt: int = 1,
+    items_check: Optional[Callable[[List[Any]], None]] = None
+) -> Dict[str, Any]:
+    """
+    Aynı anahtarla süren bir çağrı varsa onun sonucu beklenir. Öncü çağrı başarısız olursa
+    (ör. kendi tekrar kontrolüne takıldıysa) bu istek kendi çağrısını yapar; yanıtı çağıran
+    taraf zaten ayrıca doğruluyor.
+    """
+    inflight = GPT_INFLIGHT.get(call_key)
+    if inflight is not None:
+        try:
+            return await asyncio.shield(inflight)
+        except Exception as e:
+            logger.debug("⏭️ Shared GPT call failed (%s), calling GPT directly", e)
+
+    shared = asyncio.get_running_loop().create_future()
+    shared.add_done_callback(lambda f: f.cancelled() or f.exception())
+    GPT_INFLIGHT[call_key] = shared
+    try:
+        if settings.GPT_BATCHING_ENABLED:
+            ai_response = await gpt_batcher.submit(prompt, plan, attempt)
+        else:
+            ai_response = await call_gpt_with_retry(prompt, plan, attempt=attempt, items_check=items_check)
+    except BaseException as e:
+        shared.set_exception(e if isinstance(e, Exception) else RuntimeError("Shared GPT call was cancelled"))
+        raise
+    else:
+        shared.set_result(ai_response)
+    finally:
+        if GPT_INFLIGHT.get(call_key) is shared:
+            del GPT_INFLIGHT[call_key]
+    return ai_response
+
+USER_OUTFIT_CACHE: Dict[str, Dict[str, Any]] = {}
+USER_OUTFIT_CACHE_DURATION = 30 * 60  # saniye
+USER_OUTFIT_CACHE_MAX_ENTRIES = 10000
+USER_OUTFIT_CACHE_MAX_OUTFITS = 10
+
+def build_user_outfit_cache_key(request: OutfitRequest, user_info: Dict[str, Any], wardrobe_fingerprint: str) -> str:
+    """Kullanıcı, gardırop ve istek bağlamı aynı kaldıkça değişmeyen kombin havuzu anahtarı."""
+    raw_key = "|".join([
+        user_info["user_id"], user_info["gender"], request.occasion, request.weather_condition,
+        request.language, user_info["plan"], wardrobe_fingerprint
+    ])
+    return hashlib.blake2b(raw_key.encode("utf-8"), digest_size=16).hexdigest()
+
+def get_cached_user_outfits(cache_key: str) -> List[Tuple[List[SuggestedItem], Dict[str, Any]]]:
+    cached = USER_OUTFIT_CACHE.get(cache_key)
+    if cached is None:
+        return []
+    if time.time() - cached["timestamp"] >= USER_OUTFIT_CACHE_DURATION:
+        USER_OUTFIT_CACHE.pop(cache_key, None)
+        return []
+    return cached["outfits"]
+
+def remember_user_outfit(cache_key: str, outfit: Tuple[List[SuggestedItem], Dict[str, Any]]) -> None:
+    cached = USER_OUTFIT_CACHE.get(cache_key)
+    if cached is None or time.time() - cached["timestamp"] >= USER_OUTFIT_CACHE_DURATION:
+        if cached is None and len(USER_OUTFIT_CACHE) >= USER_OUTFIT_CACHE_MAX_ENTRIES:
+            USER_OUTFIT_CACHE.pop(next(iter(USER_OUTFIT_CACHE)))
+        cached = USER_OUTFIT_CACHE[cache_key] = {"timestamp": time.time(), "outfits": []}
+    cached["outfits"] = [*cached["outfits"][-(USER_OUTFIT_CACHE_MAX_OUTFITS - 1):], outfit]
+
+_pending_writes: set = set()
+
+def spawn_background_write(coro) -> asyncio.Task:
+    """Yanıtı bekletmeden Firestore yazısını başlatır; task referansı bitene kadar tutulur."""
+    task = asyncio.create_task(coro)
+    _pending_writes.add(task)
+    task.add_done_callback(_pending_writes.discard)
+    return task
+
+def shift_cached_usage(user_id: str, delta: int) -> None:
+    cached_user = user_cache.get_cached_user(user_id)
+    if cached_user is not None:
+        usage_data = cached_user.get("usage", {})
+        user_cache.update_cached_user(user_id, {"usage": {**usage_data, "count": usage_data.get("count", 0) + delta}})
+
+async def adjust_usage_count(user_id: str, delta: int, reset_date: Optional[str] = None) -> None:
+    """`reset_date` verilirse günlük kullanım, gün henüz sıfırlanmamışsa o güne sıfırlanıp `delta` ile başlatılır."""
+    user_ref = db.collection('users').document(user_id)
+    
+    @firestore.async_transactional
+    async def reset_usage(transaction) -> None:
+        snapshot = await user_ref.get(transaction=transaction)
+        usage_data = (snapshot.to_dict() or {}).get('usage') or {}
+        if usage_data.get('date') == reset_date:
+            # Gün araya giren bir yazıyla (ör. ödül hakkı) zaten sıfırlanmış; sayaç ve ödül korunur
+            transaction.update(user_ref, {'usage.count': firestore.Increment(delta)})
+        else:
+            transaction.update(user_ref, {'usage.date': reset_date, 'usage.count': delta, 'usage.rewarded_count': 0})
+    
+    try:
+        if reset_date is None:
+            await user_ref.update({'usage.count': firestore.Increment(delta)})
+        else:
+            await reset_usage(db.transaction())
+    except Exception:
+        user_cache.invalidate_cached_user(user_id)
+        logger.exception("❌ Failed to adjust usage count by %d for user %s", delta, user_id[:16])
+
+USAGE_FLUSH_INTERVAL = 0.1  # saniye
+USAGE_BATCH_MAX_WRITES = 450  # Firestore batch sınırı 500
+
+class UsageWriteBuffer:
+    """
+    Kullanım sayacı yazılarını USAGE_FLUSH_INTERVAL boyunca biriktirip tek bir WriteBatch ile gönderir.
+    Aynı kullanıcının artışları tek Increment'te birleşir (toplama sırası önemsiz); gün sıfırlaması
+    önceki artışların yerine geçer ve transaction ile yazılır. Bir kullanıcının commit'leri sırayla
+    uygulanır: yeni commit, o kullanıcının önceki commit'i bitmeden başlamaz.
+    Batch başarısız olursa yazılar tek tek denenir. Firestore'a henüz ulaşmamış yazılar
+    `unsettled` içinde tutulur ve cache Firestore'dan yeniden doldurulurken sayaca tekrar uygulanır.
+    """
+    def __init__(self, interval: float, max_writes: int):
+        self.interval, self.max_writes = interval, max_writes
+        self.pending: Dict[str, Dict[str, Any]] = {}
+        self.flush_handle: Optional[asyncio.TimerHandle] = None
+        self.last_commits: Dict[str, asyncio.Task] = {}
+        self.unsettled: Dict[str, List[Dict[str, Any]]] = {}
+    
+    def add(self, user_id: str, delta: int, reset_date: Optional[str] = None) -> None:
+        entry = self.pending.get(user_id)
+        if entry is None or reset_date is not None:
+            entry = self.pending[user_id] = {"delta": delta, "reset_date": reset_date}
+            self.unsettled.setdefault(user_id, []).append(entry)
+        else:
+            entry["delta"] += delta
+        
+        if len(self.pending) >= self.max_writes:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(self.interval, self.flush)
+    
+    def flush(self) -> None:
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        entries, self.pending = self.pending, {}
+        writes = []
+        for user_id, entry in entries.items():
+            if entry["delta"] != 0 or entry["reset_date"] is not None:
+                writes.append((user_id, entry))
+            else:
+                self._settle(user_id, entry)
+        for start in range(0, len(writes), self.max_writes):
+            chunk = writes[start:start + self.max_writes]
+            user_ids = [user_id for user_id, _ in chunk]
+            previous = {self.last_commits[user_id] for user_id in user_ids if user_id in self.last_commits}
+            task = spawn_background_write(self._commit(chunk, previous))
+            for user_id in user_ids:
+                self.last_commits[user_id] = task
+            task.add_done_callback(partial(self._forget, user_ids=user_ids))
+    
+    def _forget(self, task: asyncio.Task, user_ids: List[str]) -> None:
+        for user_id in user_ids:
+            if self.last_commits.get(user_id) is task:
+                del self.last_commits[user_id]
+    
+    def _settle(self, user_id: str, entry: Dict[str, Any]) -> None:
+        remaining = [pending for pending in self.unsettled.get(user_id, []) if pending is not entry]
+        if remaining:
+            self.unsettled[user_id] = remaining
+        else:
+            self.unsettled.pop(user_id, None)
+    
+    def apply_unsettled(self, user_id: str, user_data: Dict[str, Any]) -> None:
+        """Refill hook'u: bekleyen yazıları, Firestore'daki gibi sırayla dokümanın kullanım sayacına uygular."""
+        entries = self.unsettled.get(user_id)
+        if not entries:
+            return
+        usage_data = dict(user_data.get("usage") or {})
+        for entry in entries:
+            if entry["reset_date"] is not None and usage_data.get("date") != entry["reset_date"]:
+                usage_data = {"count": entry["delta"], "date": entry["reset_date"], "rewarded_count": 0}
+            else:
+                usage_data["count"] = usage_data.get("count", 0) + entry["delta"]
+        user_data["usage"] = usage_data
+    
+    async def wait_for_commits(self, user_id: str) -> None:
+        task = self.last_commits.get(user_id)
+        if task is not None:
+            # wait() iptal edilse bile commit task'ı iptal olmaz
+            await asyncio.wait({task})
+    
+    async def _commit(self, writes: List[Tuple[str, Dict[str, Any]]], previous: set) -> None:
+        try:
+            await self._write(writes, previous)
+        finally:
+            for user_id, entry in writes:
+                self._settle(user_id, entry)
+    
+    async def _write(self, writes: List[Tuple[str, Dict[str, Any]]], previous: set) -> None:
+        if previous:
+            await asyncio.gather(*previous, return_exceptions=True)
+        increments = [(user_id, entry) for user_id, entry in writes if entry["reset_date"] is None]
+        individual_writes = [(user_id, entry) for user_id, entry in writes if entry["reset_date"] is not None]
+        
+        if increments:
+            batch = db.batch()
+            for user_id, entry in increments:
+                batch.update(db.collection('users').document(user_id), {'usage.count': firestore.Increment(entry["delta"])})
+            try:
+                await batch.commit()
+            except Exception as e:
+                # Örn. silinmiş bir kullanıcı tüm batch'i düşürür; diğerlerini kaybetmemek için tek tek yaz
+                logger.warning("⚠️ Usage batch of %d writes failed (%s), retrying individually", len(increments), e)
+                individual_writes = increments + individual_writes
+        
+        if individual_writes:
+            await asyncio.gather(*(
+                adjust_usage_count(user_id, entry["delta"], entry["reset_date"]) for user_id, entry in individual_writes
+            ))
+    
+    async def drain(self) -> None:
+        """Kapanışta bekleyen yazıları gönderir ve tamamlanmalarını bekler."""
+        self.flush()
+        if _pending_writes:
+            await asyncio.gather(*_pending_writes, return_exceptions=True)
+
+usage_write_buffer = UsageWriteBuffer(USAGE_FLUSH_INTERVAL, USAGE_BATCH_MAX_WRITES)
+user_cache.add_refill_hook(usage_write_buffer.apply_unsettled)
+
+async def record_suggestion(user_id: str, new_outfit: Dict[str, Any]) -> None:
+    """
+    Yeni kombini, yanıt döndükten sonra son kombinlerin başına ekler (kullanım sayacı istek
+    başında artırılır). Liste transaction içinde okunup yazıldığından aynı kullanıcının eş
+    zamanlı istekleri birbirinin kombinini ezmez; eş zamanlı istekler aynı kombini ürettiyse
+    eski kopyası listeden çıkarılır.
+    """
+    user_ref = db.collection('users').document(user_id)
+    new_items = sorted(new_outfit.get('items', []))
+    
+    @firestore.async_transactional
+    async def prepend_outfit(transaction) -> List[Dict[str, Any]]:
+        snapshot = await user_ref.get(transaction=transaction)
+        stored_outfits = (snapshot.to_dict() or {}).get('recent_outfits', []) if snapshot.exists else []
+        other_outfits = [outfit for outfit in stored_outfits if sorted(outfit.get('items', [])) != new_items]
+        recent_outfits = [new_outfit, *other_outfits[:RECENT_OUTFITS_LIMIT - 1]]
+        transaction.update(user_ref, {'recent_outfits': recent_outfits})
+        return recent_outfits
+    
+    try:
+        recent_outfits = await prepend_outfit(db.transaction())
+        user_cache.update_cached_user(user_id, {'recent_outfits': recent_outfits})
+    except Exception:
+        user_cache.invalidate_cached_user(user_id)
+        logger.exception("❌ Failed to record suggestion for user %s", user_id[:16])
+
 @router.get("/occasion-rules", tags=["config"])
 async def get_occasion_rules(
     request: Request,
     user_data: Tuple[str, bool] = Depends(get_current_user_id)
 ):
     user_id, is_anonymous = user_data
-    print(f"🔧 Serving occasion rules to {'guest' if is_anonymous else 'authenticated'} user: {user_id[:16]}...")
-    
-    simplified_female = simplify_rules_for_client(OCCASION_REQUIREMENTS_FEMALE)
-    simplified_male = simplify_rules_for_client(OCCASION_REQUIREMENTS_MALE)
+    logger.debug("🔧 Serving occasion rules to %s user: %s...", 'guest' if is_anonymous else 'authenticated', user_id[:16])
     
-    return {"female": simplified_female, "male": simplified_male}
+    return SIMPLIFIED_OCCASION_RULES
 
-@router.post("/suggest-outfit", response_model=OutfitResponse, summary="Creates a personalized outfit suggestion")
+@router.post("/suggest-outfit", response_model=OutfitResponse, response_class=ORJSONResponse, summary="Creates a personalized outfit suggestion")
 async def suggest_outfit(
     request: OutfitRequest, 
+    background_tasks: BackgroundTasks,
     user_info: dict = Depends(check_usage_and_get_user_data)
 ):
+    # Hak, limit kontrolüyle aynı event-loop adımında ayrılır; böylece aynı kullanıcının eş zamanlı
+    # istekleri limiti birlikte aşamaz. Firestore artışı GPT çağrısıyla paralel yürür, istek
+    # başarısız olursa hak iade edilir.
+    user_id = user_info["user_id"]
+    shift_cached_usage(user_id, 1)
+    usage_write_buffer.add(user_id, 1, reset_date=user_info["usage_reset_date"])
+    usage_reserved = True
     try:
-        outfit_engine.check_wardrobe_compatibility(
-            request.occasion, request.wardrobe, user_info["gender"]
-        )
-        
-        requirements_map = (OCCASION_REQUIREMENTS_MALE if user_info["gender"] == 'male' 
-                          else OCCASION_REQUIREMENTS_FEMALE)
-        occasion_rules = requirements_map.get(request.occasion, {})
-        forbidden_categories = occasion_rules.get("forbidden_categories", set())
+        outfit_engine.check_wardrobe_compatibility(request.occasion, request.wardrobe, user_info["gender"])
+        rules_key = (rules_gender(user_info["gender"]), request.occasion)
+        forbidden_categories = FORBIDDEN_CATEGORIES_BY_OCCASION.get(rules_key, NO_FORBIDDEN_CATEGORIES)
         
         filtered_wardrobe = [
             item for item in request.wardrobe 
@@ -292,89 +1066,174 @@ async def suggest_outfit(
         ]
         request.wardrobe = filtered_wardrobe if filtered_wardrobe else request.wardrobe
         
+        # Etkinliğin yapılarına girmeyen parçalar prompt'tan çıkarılır; GPT'ye yeterli seçenek kalmıyorsa çıkarılmaz
+        off_structure_categories = OFF_STRUCTURE_CATEGORIES_BY_OCCASION.get(rules_key, NO_FORBIDDEN_CATEGORIES)
+        if off_structure_categories:
+            focused_wardrobe = [item for item in request.wardrobe if item.category not in off_structure_categories]
+            if len(focused_wardrobe) >= PROMPT_MIN_FOCUSED_ITEMS:
+                request.wardrobe = focused_wardrobe
+        
         if not request.wardrobe:
             raise HTTPException(status_code=400, detail="Wardrobe cannot be empty.")
+        
+        request.wardrobe = outfit_engine.prefilter_wardrobe(request.wardrobe, request.weather_condition)
 
         max_attempts = 2
         final_items = None
         ai_response = None
-        base_prompt = outfit_engine.create_advanced_prompt(request, user_info["recent_outfits"])
-        existing_outfits_ids = [
-            sorted(outfit.get("items", [])) 
+        base_prompt = outfit_engine.create_advanced_prompt(request)
+        wardrobe_map = {item.id: item for item in request.wardrobe}
+        wardrobe_fingerprint = ",".join(sorted(wardrobe_map))
+        existing_outfits_ids = {
+            tuple(sorted(outfit.get("items", []))) 
             for outfit in user_info.get("recent_outfits", [])
-        ]
-        hard_avoid_ids = set()
+        }
+        def is_repeated_outfit(outfit_ids: Tuple[str, ...], avoided_ids: Tuple[str, ...]) -> bool:
+            if user_info["is_anonymous"]:
+                return False
+            return outfit_ids in existing_outfits_ids or any(item_id in avoided_ids for item_id in outfit_ids)
+
+        # Tekrar nedeniyle reddedilen kombinler; sonraki denemenin kaçınma listesi bunlardan kurulur
+        rejected_outfits: List[Tuple[str, ...]] = []
+        recent_item_ids = {item_id for outfit_ids in existing_outfits_ids for item_id in outfit_ids}
+        category_counts = Counter(item.category for item in request.wardrobe)
+
+        def build_avoided_ids(rejected_ids: Tuple[str, ...]) -> Tuple[str, ...]:
+            # Reddedilen kombinin son kombinlerle örtüşen parçaları yasaklanır; kategorisindeki tek parça
+            # yasaklanmaz, yoksa o slot boş kalır ve sonraki deneme hiç başarılı olamaz.
+            return tuple(
+                item_id for item_id in rejected_ids
+                if item_id in recent_item_ids and category_counts[wardrobe_map[item_id].category] > 1
+            )
 
-        for attempt in range(1, max_attempts + 1):
-            print(f"🤖 AI outfit generation attempt {attempt}/{max_attempts} for {user_info['plan']} user...")
+        async def run_attempt(
+            attempt: int, avoided_ids: Tuple[str, ...] = ()
+        ) -> Optional[Tuple[List[SuggestedItem], Dict[str, Any]]]:
+            logger.debug("🤖 AI outfit generation attempt %d/%d for %s user...", attempt, max_attempts, user_info['plan'])
             
+            # Yalnızca bu denemenin prompt'unda yasaklanan ID'ler kontrol edilir
             current_prompt = base_prompt
-            if hard_avoid_ids:
-                avoid_prompt = f"\nCRITICAL AVOIDANCE RULE: You are strictly forbidden from using any of these item IDs: {', '.join(hard_avoid_ids)}\n"
+            if avoided_ids:
+                avoid_prompt = f"\nCRITICAL AVOIDANCE RULE: You are strictly forbidden from using any of these item IDs: {', '.join(avoided_ids)}\n"
                 current_prompt += avoid_prompt
 
-            response_content = await call_gpt_with_retry(
-                current_prompt, user_info["plan"], attempt=attempt
-            )
-            current_ai_response = json.loads(response_content)
+            def ensure_usable_items(items_from_ai: List[Any]) -> None:
+                # "items" dizisi kapanır kapanmaz çalışır; kullanılamaz veya tekrar eden kombinde
+                # stream kapatılır ve yanıtın kalan token'ları beklenmez
+                try:
+                    usable_items = outfit_engine.validate_outfit_structure(items_from_ai, wardrobe_map)
+                except ValueError as e:
+                    raise UnusableGPTResponse(f"AI response items are malformed: {e}")
+                if not usable_items:
+                    raise UnusableGPTResponse("AI response contains no items from the wardrobe")
+                outfit_ids = tuple(sorted(item.id for item in usable_items))
+                if is_repeated_outfit(outfit_ids, avoided_ids):
+                    rejected_outfits.append(outfit_ids)
+                    raise UnusableGPTResponse("AI response repeats a recent outfit")
+
+            call_key = build_gpt_call_key(request, user_info, wardrobe_fingerprint, current_prompt, attempt)
+            try:
+                current_ai_response = await shared_gpt_completion(
+                    current_prompt, user_info["plan"], call_key, attempt=attempt,
+                    items_check=ensure_usable_items
+                )
+            except UnusableGPTResponse as e:
+                logger.debug("⏭️ Attempt %d aborted while streaming: %s", attempt, e)
+                return None
             validated_items = outfit_engine.validate_outfit_structure(
-                current_ai_response.get("items", []), request.wardrobe
+                current_ai_response.get("items", []), wardrobe_map
             )
             
-            if not validated_items: continue
-            new_outfit_ids = sorted([item.id for item in validated_items])
+            if not validated_items: return None
+            new_outfit_ids = tuple(sorted(item.id for item in validated_items))
             
-            if not user_info["is_anonymous"]:
-                if (new_outfit_ids in existing_outfits_ids or 
-                    any(item_id in hard_avoid_ids for item_id in new_outfit_ids)):
-                    for item_id in new_outfit_ids: hard_avoid_ids.add(item_id)
-                    continue
+            if is_repeated_outfit(new_outfit_ids, avoided_ids):
+                rejected_outfits.append(new_outfit_ids)
+                return None
             
-            final_items = validated_items
-            ai_response = current_ai_response
-            break
+            return validated_items, current_ai_response
+
+        # Aynı gardırop ve bağlamla daha önce üretilmiş, son kombinlerde olmayan bir kombin varsa GPT çağrılmaz.
+        # Misafirlerde tekrar kontrolü yapılmadığından aynı kombin dönüp durur; bu cache onlarda kullanılmaz.
+        use_outfit_cache = not user_info["is_anonymous"]
+        outfit_cache_key = build_user_outfit_cache_key(request, user_info, wardrobe_fingerprint)
+        attempt_result = next(
+            (cached_outfit for cached_outfit in get_cached_user_outfits(outfit_cache_key)
+             if not is_repeated_outfit(tuple(sorted(item.id for item in cached_outfit[0])), ())),
+            None
+        ) if use_outfit_cache else None
+        served_from_cache = attempt_result is not None
+        if served_from_cache:
+            logger.debug("✅ Serving a previously generated outfit (%s)", outfit_cache_key[:8])
+        else:
+            # Denemeler sıralıdır: ikinci deneme yalnızca ilki tekrar ya da geçersiz çıktığında yapılır ve
+            # reddedilen kombinin parçalarından kaçınır. Tekrar eden kombin stream sırasında yakalandığı
+            # için ikinci deneme yanıtın tamamı beklenmeden başlar.
+            avoided_ids: Tuple[str, ...] = ()
+            for attempt in range(1, max_attempts + 1):
+                try:
+                    attempt_result = await run_attempt(attempt, avoided_ids)
+                except Exception:
+                    # Önceki deneme tekrar döndürdüyse hata yerine SAME_OUTFIT (422) döner
+                    if not rejected_outfits:
+                        raise
+                    logger.warning("⚠️ Attempt %d failed after a repeated outfit", attempt, exc_info=True)
+                    break
+                if attempt_result is not None:
+                    break
+                if rejected_outfits:
+                    avoided_ids = build_avoided_ids(rejected_outfits[-1])
+        
+        if attempt_result is not None:
+            final_items, ai_response = attempt_result
+            if use_outfit_cache and not served_from_cache:
+                remember_user_outfit(outfit_cache_key, attempt_result)
         
         if not final_items:
             error_message = SAME_OUTFIT_ERRORS.get(request.language, SAME_OUTFIT_ERRORS["en"])
             raise HTTPException(status_code=422, detail=error_message)
 
+        # Yanıt doğrudan sözlük olarak serileştirilir; alanlar yukarıda zaten doğrulandığı için
+        # OutfitResponse yalnızca DEBUG modunda yeniden kurulur.
         response_data = {
-            "items": final_items, 
-            "description": ai_response.get("description", ""), 
-            "suggestion_tip": ai_response.get("suggestion_tip", ""), 
+            "items": [{"id": item.id, "name": item.name, "category": item.category} for item in final_items], 
+            "description": ai_response.get("description") or "", 
+            "suggestion_tip": ai_response.get("suggestion_tip") or "", 
             "pinterest_links": []
         }
         
         if user_info["plan"] == "premium" and "pinterest_links" in ai_response:
-            final_pinterest_links = []
-            for link_idea in ai_response.get("pinterest_links", []):
-                if "search_query" in link_idea and link_idea["search_query"]:
-                    encoded_query = quote(link_idea["search_query"])
-                    final_pinterest_links.append(PinterestLink(
-                        title=link_idea.get("title", "Inspiration"), 
-                        url=f"https://www.pinterest.com/search/pins/?q={encoded_query}"
-                    ))
-            response_data["pinterest_links"] = final_pinterest_links
+            response_data["pinterest_links"] = [
+                {"title": link_idea.get("title", "Inspiration"), "url": PINTEREST_SEARCH_URL + quote(search_query)}
+                for link_idea in ai_response["pinterest_links"] or ()
+                if isinstance(link_idea, dict) and (search_query := link_idea.get("search_query"))
+            ]
         
         new_outfit_map = {"items": sorted([item.id for item in final_items])}
-        updated_outfits = [new_outfit_map] + user_info.get("recent_outfits", [])
-        trimmed_outfits = updated_outfits[:5]
+        trimmed_outfits = [new_outfit_map, *user_info["recent_outfits"][:RECENT_OUTFITS_LIMIT - 1]]
 
-        db.collection('users').document(user_info["user_id"]).update({
-            'usage.count': firestore.Increment(1), 
-            'recent_outfits': trimmed_outfits
-        })
-        print(f"✅ Suggestion provided for {'guest' if user_info['is_anonymous'] else 'authenticated'} user ({user_info['plan']} plan) in '{request.language}'")
+        if settings.DEBUG:
+            OutfitResponse(**response_data)
+        user_cache.update_cached_user(user_id, {"recent_outfits": trimmed_outfits})
+        background_tasks.add_task(record_suggestion, user_id, new_outfit_map)
+        usage_reserved = False
+        logger.info("✅ Suggestion provided for %s user (%s plan) in '%s'", 'guest' if user_info['is_anonymous'] else 'authenticated', user_info['plan'], request.language)
         
-        return OutfitResponse(**response_data)
+        return ORJSONResponse(content=response_data)
         
     except HTTPException as http_exc:
         raise http_exc
-    except json.JSONDecodeError:
+    except GPTUnavailable:
+        raise HTTPException(status_code=503, detail="AI service is temporarily unavailable. Please try again shortly.")
+    except orjson.JSONDecodeError:
         raise HTTPException(status_code=502, detail="Failed to parse AI response.")
-    except Exception as e:
-        print(f"❌ Unhandled error in suggest_outfit: {traceback.format_exc()}")
-        raise HTTPException(status_code=500, detail=f"An internal server error occurred: {str(e)}")
+    except Exception:
+        logger.exception("❌ Unhandled error in suggest_outfit")
+        raise HTTPException(status_code=500, detail="An internal server error occurred.")
+    finally:
+        if usage_reserved:
+            shift_cached_usage(user_id, -1)
+            usage_write_buffer.add(user_id, -1)
 
 @router.get("/usage-status", tags=["users"])
 async def get_usage_status(
@@ -383,15 +1242,13 @@ async def get_usage_status(
 ):
     try:
         user_id, is_anonymous = user_data_tuple
-        today = str(date.today())
+        today = get_today_str()
         
-        user_ref = db.collection('users').document(user_id)
-        user_doc = user_ref.get()
+        user_data_dict = await fetch_user_data(user_id)
         
-        if not user_doc.exists:
+        if user_data_dict is None:
             raise HTTPException(status_code=404, detail="User not found")
         
-        user_data_dict = user_doc.to_dict()
         plan = user_data_dict.get("plan", "free")
         usage_data = user_data_dict.get("usage", {})
         
@@ -413,8 +1270,8 @@ async def get_usage_status(
             "is_anonymous": is_anonymous
         }
             
-    except Exception as e:
-        print(f"Error getting usage status: {str(e)}")
+    except Exception:
+        logger.exception("Error getting usage status")
         raise HTTPException(status_code=500, detail="Failed to get usage status")
 
 @router.get("/gpt-status", tags=["dev"])
@@ -422,10 +1279,17 @@ async def get_gpt_status(
     request: Request,
     user_data: Tuple[str, bool] = Depends(get_current_user_id)
 ):
+    available = [name for name in gpt_balancer.state if gpt_balancer.is_available(name)]
     return {
-        "primary_failures": gpt_balancer.primary_failures,
-        "secondary_failures": gpt_balancer.secondary_failures,
+        "clients": {
+            name: {
+                "failures": client_state["failures"], "inflight": client_state["inflight"],
+                "recent_failures": gpt_balancer.recent_failure_count(name),
+                "ewma_ms": round(client_state["ewma_ms"], 1), "circuit_trips": client_state["trips"],
+                "available": name in available
+            }
+            for name, client_state in gpt_balancer.state.items()
+        },
         "max_failures": gpt_balancer.max_failures,
-        "status": "healthy" if (gpt_balancer.primary_failures < gpt_balancer.max_failures or 
-                              gpt_balancer.secondary_failures < gpt_balancer.max_failures) else "degraded"
+        "status": "healthy" if available else "degraded"
     }
\ No newline at end of file
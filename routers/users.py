@@ -1,14 +1,17 @@
 from fastapi import APIRouter, Depends, Body, Request, HTTPException
 from firebase_admin import firestore
 from pydantic import BaseModel
-from datetime import date
 from typing import Tuple, Optional
+import asyncio
 import hmac
+import logging
 import hashlib
 import os
-import datetime
+import orjson
 
 from core.security import get_current_user_id
+from core.usage import get_today_str
+from core.user_cache import get_cached_user, invalidate_cached_user, set_cached_user, update_cached_user
 from schemas import DailyUsage # schemas.py'den DailyUsage'ı import edelim
 
 router = APIRouter(
@@ -20,6 +23,7 @@ webhook_router = APIRouter(
     tags=["webhooks"]
 )
 db = firestore.client()
+logger = logging.getLogger(__name__)
 
 class UserInfoUpdate(BaseModel):
     name: str
@@ -39,21 +43,24 @@ async def get_user_profile(
     user_id, is_anonymous = user_data_tuple
     
     user_ref = db.collection('users').document(user_id)
-    user_doc = user_ref.get()
+    user_data_dict = get_cached_user(user_id)
     
-    if not user_doc.exists:
-        raise HTTPException(status_code=404, detail="User profile not found in database.")
-    
-    user_data_dict = user_doc.to_dict()
+    if user_data_dict is None:
+        user_doc = await asyncio.to_thread(user_ref.get)
+        if not user_doc.exists:
+            raise HTTPException(status_code=404, detail="User profile not found in database.")
+        user_data_dict = user_doc.to_dict()
+        set_cached_user(user_id, user_data_dict)
     
     fullname = user_data_dict.get("fullname")
     gender = user_data_dict.get("gender")
     is_profile_complete_calculated = bool(fullname and gender and gender != 'unisex')
     
     if user_data_dict.get("profile_complete") != is_profile_complete_calculated:
-        user_ref.update({"profile_complete": is_profile_complete_calculated})
+        await asyncio.to_thread(user_ref.update, {"profile_complete": is_profile_complete_calculated})
+        update_cached_user(user_id, {"profile_complete": is_profile_complete_calculated})
 
-    usage_status = get_or_create_daily_usage(user_id)
+    usage_status = await asyncio.to_thread(get_or_create_daily_usage, user_id, user_data_dict)
     
     return {
         "user_id": user_id,
@@ -75,7 +82,7 @@ async def update_user_info(
     user_id, _ = user_data_tuple
     user_ref = db.collection('users').document(user_id)
 
-    if not user_ref.get().exists:
+    if not (await asyncio.to_thread(user_ref.get)).exists:
         raise HTTPException(status_code=404, detail="User not found.")
 
     is_profile_complete = bool(update_data.name and update_data.gender and update_data.gender != 'unisex')
@@ -86,7 +93,8 @@ async def update_user_info(
         "profile_complete": is_profile_complete,
         "updatedAt": firestore.SERVER_TIMESTAMP
     }
-    user_ref.update(db_update_data)
+    await asyncio.to_thread(user_ref.update, db_update_data)
+    invalidate_cached_user(user_id)
     
     return {
         "status": "success",
@@ -102,17 +110,18 @@ async def update_user_plan(
     user_id, _ = user_data_tuple
     user_ref = db.collection('users').document(user_id)
     
-    if not user_ref.get().exists:
+    if not (await asyncio.to_thread(user_ref.get)).exists:
         raise HTTPException(status_code=404, detail="User profile not found.")
     
     new_plan = plan_data.plan
     if new_plan not in ["free", "premium"]:
         raise HTTPException(status_code=400, detail="Invalid plan type.")
     
-    user_ref.update({
+    await asyncio.to_thread(user_ref.update, {
         "plan": new_plan,
         "planUpdatedAt": firestore.SERVER_TIMESTAMP
     })
+    invalidate_cached_user(user_id)
     
     return {
         "status": "success",
@@ -127,7 +136,7 @@ async def grant_rewarded_suggestion(
     user_id, _ = user_data_tuple
     try:
         user_ref = db.collection('users').document(user_id)
-        today = str(date.today())
+        today = get_today_str()
         
         @firestore.transactional
         def update_reward_in_transaction(transaction, user_ref_trans):
@@ -144,7 +153,8 @@ async def grant_rewarded_suggestion(
             return new_rewarded_count
 
         transaction = db.transaction()
-        final_reward_count = update_reward_in_transaction(transaction, user_ref)
+        final_reward_count = await asyncio.to_thread(update_reward_in_transaction, transaction, user_ref)
+        invalidate_cached_user(user_id)
 
         return {
             "status": "success",
@@ -155,7 +165,7 @@ async def grant_rewarded_suggestion(
             }
         }
     except Exception as e:
-        print(f"Error granting rewarded suggestion: {str(e)}")
+        logger.error("Error granting rewarded suggestion: %s", e)
         raise HTTPException(status_code=500, detail="Failed to grant rewarded suggestion right.")
 
 @router.delete("/delete-account")
@@ -165,12 +175,13 @@ async def delete_user_account(
     user_id, _ = user_data_tuple
     try:
         user_ref = db.collection('users').document(user_id)
-        if user_ref.get().exists:
-            user_ref.delete()
-            print(f"🗑️ Firestore document for user {user_id} deleted.")
+        if (await asyncio.to_thread(user_ref.get)).exists:
+            await asyncio.to_thread(user_ref.delete)
+            invalidate_cached_user(user_id)
+            logger.info("🗑️ Firestore document for user %s deleted.", user_id)
         return {"status": "success", "message": "Account permanently deleted."}
     except Exception as e:
-        print(f"❌ Error deleting account for user {user_id}: {str(e)}")
+        logger.error("❌ Error deleting account for user %s: %s", user_id, e)
         raise HTTPException(status_code=500, detail="Could not delete account.")
 
 @router.post("/verify-purchase")
@@ -179,8 +190,8 @@ async def verify_purchase(
     user_data_tuple: Tuple[str, bool] = Depends(get_current_user_id)
 ):
     user_id, _ = user_data_tuple
-    print(f"Received purchase verification for user: {user_id}")
-    print(f"Customer Info from client: {request_data.customer_info}")
+    logger.info("Received purchase verification for user: %s", user_id)
+    logger.info("Customer Info from client: %s", request_data.customer_info)
     return {"status": "received", "message": "Verification data received for logging."}
 
 def verify_webhook_signature(signature: str, body: bytes) -> bool:
@@ -191,7 +202,7 @@ def verify_webhook_signature(signature: str, body: bytes) -> bool:
         expected_signature = hmac.new(webhook_secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
         return hmac.compare_digest(expected_signature, signature.split('sha256=')[-1])
     except Exception as e:
-        print(f"Signature verification error: {e}")
+        logger.warning("Signature verification error: %s", e)
         return False
 
 def determine_plan_from_entitlements_webhook(entitlements: dict) -> str:
@@ -206,7 +217,7 @@ async def handle_revenuecat_webhook(request: Request):
     if not verify_webhook_signature(signature, body):
         raise HTTPException(status_code=401, detail="Invalid webhook signature.")
     try:
-        webhook_data = await request.json()
+        webhook_data = orjson.loads(body)
         event = webhook_data.get("event", {})
         event_type = event.get("type")
         app_user_id = event.get("app_user_id")
@@ -215,33 +226,31 @@ async def handle_revenuecat_webhook(request: Request):
             return {"status": "warning", "message": "No app_user_id in webhook event."}
             
         user_ref = db.collection('users').document(app_user_id)
-        if not user_ref.get().exists:
+        if not (await asyncio.to_thread(user_ref.get)).exists:
             return {"status": "warning", "message": "User not found."}
 
         if event_type in ["INITIAL_PURCHASE", "RENEWAL", "UNCANCELLATION", "PRODUCT_CHANGE"]:
             new_plan = determine_plan_from_entitlements_webhook(event.get("entitlements", {}))
-            user_ref.update({"plan": new_plan, "planUpdatedAt": firestore.SERVER_TIMESTAMP, "subscriptionStatus": "active"})
+            await asyncio.to_thread(user_ref.update, {"plan": new_plan, "planUpdatedAt": firestore.SERVER_TIMESTAMP, "subscriptionStatus": "active"})
         elif event_type in ["CANCELLATION", "EXPIRATION", "BILLING_ISSUE"]:
-            user_ref.update({"plan": "free", "planUpdatedAt": firestore.SERVER_TIMESTAMP, "subscriptionStatus": "cancelled"})
+            await asyncio.to_thread(user_ref.update, {"plan": "free", "planUpdatedAt": firestore.SERVER_TIMESTAMP, "subscriptionStatus": "cancelled"})
+        invalidate_cached_user(app_user_id)
             
         return {"status": "success"}
     except Exception as e:
-        print(f"Webhook processing error: {str(e)}")
+        logger.error("Webhook processing error: %s", e)
         return {"status": "error", "message": str(e)}
 
 # --- DEĞİŞİKLİK: 'get_or_create_daily_usage' fonksiyonunu core/usage.py'den buraya taşıdık.
-def get_or_create_daily_usage(user_id: str) -> DailyUsage:
+def get_or_create_daily_usage(user_id: str, user_data: Optional[dict] = None) -> DailyUsage:
+    """`user_data` verilirse (ör. profil okumasından) doküman tekrar okunmaz."""
     user_ref = db.collection('users').document(user_id)
-    user_doc = user_ref.get()
-    
-    if not user_doc.exists:
-        plan = "free"
-        user_data = {}
-    else:
-        user_data = user_doc.to_dict()
-        plan = user_data.get("plan", "free")
+    if user_data is None:
+        user_doc = user_ref.get()
+        user_data = user_doc.to_dict() if user_doc.exists else {}
+    plan = user_data.get("plan", "free")
 
-    today_str = datetime.date.today().isoformat()
+    today_str = get_today_str()
     usage_data = user_data.get("usage")
     
     if usage_data and usage_data.get("date") == today_str:
@@ -252,6 +261,7 @@ def get_or_create_daily_usage(user_id: str) -> DailyUsage:
         rewarded_count = 0
         new_usage_data = {"date": today_str, "count": 0, "rewarded_count": 0}
         user_ref.set({"usage": new_usage_data}, merge=True)
+        invalidate_cached_user(user_id)
 
     from core.usage import PLAN_LIMITS
     daily_limit = PLAN_LIMITS.get(plan, PLAN_LIMITS["free"])
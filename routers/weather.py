@@ -1,4 +1,5 @@
 import httpx
+import logging
 from fastapi import APIRouter, Depends, HTTPException, Request
 from datetime import datetime, timedelta
 from typing import Tuple
@@ -12,9 +13,24 @@ router = APIRouter(
     dependencies=[Depends(get_current_user_id)]  # Hem authenticated hem anonymous kullanıcılar için
 )
 
+logger = logging.getLogger(__name__)
+
 WEATHER_CACHE = {}
 CACHE_DURATION = timedelta(hours=1)
 
+# Koordinat formatındaki ("41.01_28.97") isimleri tanımak için ayraçları tek geçişte sil
+_COORDINATE_SEPARATORS = str.maketrans("", "", "._-")
+
+# Her istekte yeni bağlantı/TLS el sıkışması yapmamak için OpenWeatherMap çağrıları tek havuzu paylaşır
+WEATHER_TIMEOUT = httpx.Timeout(10.0, connect=2.0)
+weather_http_client = httpx.AsyncClient(
+    timeout=WEATHER_TIMEOUT,
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=100, keepalive_expiry=60),
+)
+
+async def close_client() -> None:
+    await weather_http_client.aclose()
+
 async def _get_city_name_from_geocoding(lat: float, lon: float) -> str:
     """Reverse geocoding API'sini kullanarak şehir ismini al"""
     url = "http://api.openweathermap.org/geo/1.0/reverse"
@@ -25,21 +41,20 @@ async def _get_city_name_from_geocoding(lat: float, lon: float) -> str:
         "appid": settings.OPENWEATHER_API_KEY
     }
     
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(url, params=params)
-            response.raise_for_status()
-            data = response.json()
+    try:
+        response = await weather_http_client.get(url, params=params)
+        response.raise_for_status()
+        data = response.json()
             
-            if data and len(data) > 0:
-                location = data[0]
-                # Önce state/il bilgisini kontrol et, yoksa name'i kullan
-                city_name = location.get("state") or location.get("name")
-                return city_name
-            else:
-                return f"{round(lat, 2)}_{round(lon, 2)}"
-        except Exception:
+        if data and len(data) > 0:
+            location = data[0]
+            # Önce state/il bilgisini kontrol et, yoksa name'i kullan
+            city_name = location.get("state") or location.get("name")
+            return city_name
+        else:
             return f"{round(lat, 2)}_{round(lon, 2)}"
+    except Exception:
+        return f"{round(lat, 2)}_{round(lon, 2)}"
 
 async def _get_city_name_from_weather(lat: float, lon: float) -> str:
     """Weather API'sinden şehir ismini al (fallback)"""
@@ -51,14 +66,13 @@ async def _get_city_name_from_weather(lat: float, lon: float) -> str:
         "units": "metric",
         "lang": "en"
     }
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(url, params=params)
-            response.raise_for_status()
-            data = response.json()
-            return data.get("name", f"{round(lat, 2)}_{round(lon, 2)}")
-        except Exception:
-            return f"{round(lat, 2)}_{round(lon, 2)}"
+    try:
+        response = await weather_http_client.get(url, params=params)
+        response.raise_for_status()
+        data = response.json()
+        return data.get("name", f"{round(lat, 2)}_{round(lon, 2)}")
+    except Exception:
+        return f"{round(lat, 2)}_{round(lon, 2)}"
 
 async def _get_city_name(lat: float, lon: float) -> str:
     """Önce geocoding, başarısız olursa weather API'sini kullan"""
@@ -66,7 +80,7 @@ async def _get_city_name(lat: float, lon: float) -> str:
     city_name = await _get_city_name_from_geocoding(lat, lon)
     
     # Eğer sadece koordinat döndüyse, weather API'sini dene
-    if "_" in city_name and city_name.replace(".", "").replace("_", "").replace("-", "").isdigit():
+    if "_" in city_name and city_name.translate(_COORDINATE_SEPARATORS).isdigit():
         city_name = await _get_city_name_from_weather(lat, lon)
     
     return city_name
@@ -86,7 +100,7 @@ async def get_weather_data(
     
     # User tipini log'la
     user_type = "anonymous" if is_anonymous else "authenticated"
-    print(f"🌤️ Weather request from {user_type} user: {user_id[:16]}...")
+    logger.debug("🌤️ Weather request from %s user: %s...", user_type, user_id[:16])
     
     city_name = await _get_city_name(lat, lon)
     cache_key = f"weather_{city_name.lower()}"
@@ -96,7 +110,7 @@ async def get_weather_data(
     if cache_key in WEATHER_CACHE:
         cached_data = WEATHER_CACHE[cache_key]
         if current_time - cached_data["timestamp"] < CACHE_DURATION:
-            print(f"✅ Serving cached weather data for {city_name}")
+            logger.debug("✅ Serving cached weather data for %s", city_name)
             return cached_data["data"]
 
     # API'den güncel veri çek
@@ -109,33 +123,32 @@ async def get_weather_data(
         "lang": "en"
     }
 
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(url, params=params)
-            response.raise_for_status()
-            weather_data = response.json()
+    try:
+        response = await weather_http_client.get(url, params=params)
+        response.raise_for_status()
+        weather_data = response.json()
 
-            # Cache için şehir ismini kullan
-            cache_city = city_name.lower()
-            final_cache_key = f"weather_{cache_city}"
+        # Cache için şehir ismini kullan
+        cache_city = city_name.lower()
+        final_cache_key = f"weather_{cache_city}"
             
-            WEATHER_CACHE[final_cache_key] = {
-                "timestamp": current_time,
-                "data": weather_data
-            }
+        WEATHER_CACHE[final_cache_key] = {
+            "timestamp": current_time,
+            "data": weather_data
+        }
             
-            print(f"✅ Fresh weather data cached for {city_name}")
-            return weather_data
+        logger.debug("✅ Fresh weather data cached for %s", city_name)
+        return weather_data
             
-        except httpx.HTTPStatusError as e:
-            print(f"❌ Weather API error for {user_type} user: {e.response.status_code}")
-            raise HTTPException(
-                status_code=e.response.status_code, 
-                detail=f"Error from OpenWeatherMap: {e.response.text}"
-            )
-        except httpx.RequestError:
-            print(f"❌ Weather API connection error for {user_type} user")
-            raise HTTPException(
-                status_code=503, 
-                detail="Could not connect to OpenWeatherMap API."
-            )
\ No newline at end of file
+    except httpx.HTTPStatusError as e:
+        logger.warning("❌ Weather API error for %s user: %s", user_type, e.response.status_code)
+        raise HTTPException(
+            status_code=e.response.status_code, 
+            detail=f"Error from OpenWeatherMap: {e.response.text}"
+        )
+    except httpx.RequestError:
+        logger.warning("❌ Weather API connection error for %s user", user_type)
+        raise HTTPException(
+            status_code=503, 
+            detail="Could not connect to OpenWeatherMap API."
+        )
\ No newline at end of file